@@ -0,0 +1,47 @@
+import streamlit as st
+import numpy as np
+import os
+from api.streamlit_experiments import parquet
+
+# Country x date cube of cumulative cases for the Kaggle COVID dataset. It is built once per
+# version of the source file and cached across reruns, and every per-country series is a
+# positional slice of it.
+CASES = ['Confirmed', 'Recovered', 'Deaths']
+COUNTRY = 'Country/Region'
+DATE = 'ObservationDate'
+
+def build_cube(covid):
+    cube = covid.groupby([COUNTRY, DATE], observed=True)[CASES].sum().sort_index()
+    countries = np.asarray(cube.index.get_level_values(COUNTRY))
+    starts = np.flatnonzero(np.r_[True, countries[1:] != countries[:-1]])
+    stops = np.r_[starts[1:], len(cube)]
+    latest = covid[DATE].max()
+    countrywise = (covid[covid[DATE] == latest].groupby(COUNTRY, observed=True)[CASES].sum()
+                   .sort_values('Confirmed', ascending=False))
+    countrywise['Mortality'] = countrywise['Deaths'] / countrywise['Confirmed'] * 100
+    countrywise['Recovery'] = countrywise['Recovered'] / countrywise['Confirmed'] * 100
+    return {
+        'raw': covid,
+        'cube': cube,
+        'world': cube.groupby(level=DATE).sum(),
+        'slices': {name: slice(start, stop) for name, start, stop in zip(countries[starts], starts, stops)},
+        'countrywise': countrywise,
+    }
+
+@st.cache(allow_output_mutation=True)
+def _load_cube(path, mtime):
+    # mtime is part of the cache key, so replacing the file rebuilds the cube
+    covid = parquet.read_csv_as_parquet(path,
+        usecols=['ObservationDate', 'Province/State', 'Country/Region', 'Last Update', 'Confirmed', 'Deaths', 'Recovered'],
+        parse_dates=['ObservationDate'], partition_on='ObservationDate')
+    return build_cube(covid)
+
+def load_cube(path):
+    return _load_cube(path, os.path.getmtime(path))
+
+def countries(data):
+    return list(data['slices'])
+
+def country(data, name):
+    # Dates the country reported on, from its first observation
+    return data['cube'].iloc[data['slices'][name]].droplevel(COUNTRY)
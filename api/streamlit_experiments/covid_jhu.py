@@ -0,0 +1,126 @@
+import pandas as pd
+import io
+import os
+import csv
+import json
+import logging
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Incremental ingestion of the JHU CSSE global time series. Each series is kept locally
+# in long format (country, date, value) as Parquet. A refresh makes a conditional request
+# (ETag / Last-Modified) and, when the file changed, only parses and appends the date
+# columns the store does not have, plus the last few days JHU tends to revise.
+JHU_BASEURL = ('https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/'
+               'csse_covid_19_data/csse_covid_19_time_series')
+JHU_SERIES = ['confirmed', 'deaths', 'recovered']
+JHU_STORE_DIR = os.environ.get('JHU_STORE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cloud-experiments', 'jhu'))
+# Directory holding copies of the time_series_covid19_*_global.csv files, to run offline
+JHU_MIRROR = os.environ.get('JHU_MIRROR')
+JHU_REVISION_DAYS = 3
+
+def series_file(series):
+    return f'time_series_covid19_{series}_global.csv'
+
+def series_source(series, mirror=None):
+    mirror = mirror or JHU_MIRROR
+    if mirror:
+        return os.path.join(mirror, series_file(series))
+    return f'{JHU_BASEURL}/{series_file(series)}'
+
+def _store_paths(series, store_dir):
+    return (os.path.join(store_dir, series + '.parquet'), os.path.join(store_dir, series + '.json'))
+
+def _fetch(source, meta):
+    # (content, version) of the source, content None when it has not changed since meta
+    if not source.startswith(('http://', 'https://')):
+        stat = os.stat(source)
+        version = {'mtime': stat.st_mtime, 'size': stat.st_size}
+        if meta.get('version') == version:
+            return None, version
+        with open(source, 'rb') as f:
+            return f.read(), version
+
+    request = urllib.request.Request(source)
+    version = meta.get('version') or {}
+    if version.get('etag'):
+        request.add_header('If-None-Match', version['etag'])
+    if version.get('last_modified'):
+        request.add_header('If-Modified-Since', version['last_modified'])
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            version = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+            return response.read(), version
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, version
+        raise
+
+def _parse_new_dates(content, since):
+    # Long rows for the date columns on or after since (all when since is None)
+    header = next(csv.reader(io.StringIO(content[:content.index(b'\n')].decode('utf-8'))))
+    dates = pd.to_datetime(pd.Series(header[4:]), format='%m/%d/%y')
+    wanted = [column for column, date in zip(header[4:], dates) if since is None or date >= since]
+    if not wanted:
+        return pd.DataFrame({'country': pd.Series(dtype='object'), 'date': pd.Series(dtype='datetime64[ns]'),
+                             'value': pd.Series(dtype='int64')})
+    wide = pd.read_csv(io.BytesIO(content), usecols=['Country/Region'] + wanted)
+    long = wide.melt(id_vars='Country/Region', var_name='date')
+    # sum over potentially duplicate rows (France and their territories)
+    long = long.groupby(['Country/Region', 'date'], sort=False)['value'].sum().reset_index()
+    long['date'] = pd.to_datetime(long['date'], format='%m/%d/%y')
+    return long.rename(columns={'Country/Region': 'country'})
+
+def update_series(series, mirror=None, store_dir=None, full=False):
+    store_dir = store_dir or JHU_STORE_DIR
+    data_path, meta_path = _store_paths(series, store_dir)
+    store, meta = None, {}
+    if not full and os.path.exists(data_path) and os.path.exists(meta_path):
+        store = pd.read_parquet(data_path)
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+    source = series_source(series, mirror)
+    try:
+        content, version = _fetch(source, meta)
+    except OSError as e:
+        if store is None:
+            raise
+        logging.warning(f'Could not refresh {series} from {source}, using the local store: {e}')
+        return store
+    if content is None:
+        return store
+
+    since = None
+    if store is not None and len(store):
+        since = store['date'].max() - pd.Timedelta(days=JHU_REVISION_DAYS)
+    new = _parse_new_dates(content, since)
+    if since is not None:
+        store = pd.concat([store[store['date'] < since], new], ignore_index=True)
+    else:
+        store = new
+    store = store.sort_values(['country', 'date'], kind='stable').reset_index(drop=True)
+
+    os.makedirs(store_dir, exist_ok=True)
+    store.to_parquet(data_path, index=False)
+    with open(meta_path, 'w') as f:
+        json.dump({'source': source, 'version': version, 'new_rows': len(new)}, f)
+    return store
+
+def refresh(mirror=None, store_dir=None, full=False):
+    # All series fetched concurrently, returned as {series: long frame}
+    with ThreadPoolExecutor(max_workers=len(JHU_SERIES)) as executor:
+        stores = executor.map(lambda series: update_series(series, mirror, store_dir, full), JHU_SERIES)
+        return dict(zip(JHU_SERIES, stores))
+
+def long_table(stores):
+    # confirmed, deaths and recovered side by side on a sorted (country, date) index with
+    # country as a categorical, so per country and per selection reads are index slices
+    table = pd.concat([stores[series].set_index(['country', 'date'])['value'].rename(series)
+                       for series in JHU_SERIES], axis=1).sort_index()
+    table.index = pd.MultiIndex.from_arrays(
+        [pd.Categorical(table.index.get_level_values('country')), table.index.get_level_values('date')],
+        names=['country', 'date'])
+    return table
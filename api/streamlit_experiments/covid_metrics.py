@@ -0,0 +1,135 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+
+# Metrics behind the covid.py charts, computed with whole-column operations and returned
+# as frames so they can be plotted, tabled or reused. Inputs are frames of cumulative
+# counts indexed by date, or by (country, date) with by='Country/Region' (any index level).
+# Inputs are never modified. Results are memoized on a hash of the input's content, so
+# reruns and repeated calls on the same series, world or per country, skip the work.
+CASES = ['Confirmed', 'Recovered', 'Deaths']
+METRICS_CACHE_SIZE = 256
+metrics_cache_stats = {'hits': 0, 'misses': 0}
+_metrics_cache = OrderedDict()
+_metrics_cache_lock = threading.Lock()
+
+def frame_digest(df):
+    rows = pd.util.hash_pandas_object(df, index=True).to_numpy()
+    header = repr([(column, str(dtype)) for column, dtype in df.dtypes.items()]).encode('utf-8')
+    return hashlib.sha256(header + rows.tobytes()).hexdigest()
+
+def memoized(fn):
+    # Least recently used results beyond METRICS_CACHE_SIZE are dropped. Callers get a copy,
+    # so changing a result does not change the cached one.
+    @functools.wraps(fn)
+    def wrapper(df, *args, **kwargs):
+        key = (fn.__name__, frame_digest(df), repr(args), repr(sorted(kwargs.items())))
+        with _metrics_cache_lock:
+            if key in _metrics_cache:
+                _metrics_cache.move_to_end(key)
+                metrics_cache_stats['hits'] += 1
+                return _metrics_cache[key].copy()
+            metrics_cache_stats['misses'] += 1
+        result = fn(df, *args, **kwargs)
+        with _metrics_cache_lock:
+            _metrics_cache[key] = result
+            while len(_metrics_cache) > METRICS_CACHE_SIZE:
+                _metrics_cache.popitem(last=False)
+        return result.copy()
+    return wrapper
+
+def metrics_cache_clear():
+    with _metrics_cache_lock:
+        _metrics_cache.clear()
+
+def _dates(df):
+    return df.index.get_level_values(-1) if isinstance(df.index, pd.MultiIndex) else df.index
+
+@memoized
+def growth_factor(df, by=None, columns=CASES):
+    # Ratio of each day's count to the previous day's, 1 on each series' first day
+    counts = df[columns]
+    if by:
+        grouped = counts.groupby(level=by)
+        previous = grouped.shift()
+        first = (grouped.cumcount() == 0).to_numpy()
+    else:
+        previous = counts.shift()
+        first = np.arange(len(counts)) == 0
+    factor = counts / previous
+    factor.loc[first] = 1
+    return factor
+
+@memoized
+def weekly_totals(df, by=None, columns=CASES):
+    # Counts at the last day of each ISO week, keyed by (Year, Week) so weeks of different
+    # years stay apart. Week Number counts the weeks of each series from 1.
+    iso = pd.DatetimeIndex(_dates(df)).isocalendar()
+    keys = pd.DataFrame({'Year': iso['year'].to_numpy(), 'Week': iso['week'].to_numpy()})
+    if by:
+        keys.insert(0, by, df.index.get_level_values(by))
+    last = ~keys.duplicated(keep='last').to_numpy()
+    weekly = df.loc[last, columns].set_axis(pd.MultiIndex.from_frame(keys[last]))
+    weekly['Week Number'] = weekly.groupby(level=by).cumcount() + 1 if by else np.arange(1, len(weekly) + 1)
+    return weekly
+
+@memoized
+def weekly_increase(df, by=None, columns=CASES):
+    weekly = weekly_totals(df, by, columns)
+    counts = weekly[columns]
+    previous = counts.groupby(level=by).shift() if by else counts.shift()
+    increase = (counts - previous).fillna(0)
+    increase['Week Number'] = weekly['Week Number']
+    return increase
+
+@memoized
+def doubling_days(df, by=None, start=1000, column='Confirmed'):
+    # Days from each series' first day until its count last stood at or below start, 2 x start,
+    # 4 x start and so on, up to the series' peak. Series must be contiguous and date sorted.
+    # All series are searched at once: each running maximum is lifted by series number x span,
+    # so the concatenation stays sorted and one searchsorted finds every threshold.
+    dates = pd.DatetimeIndex(_dates(df))
+    if by:
+        codes, names = pd.factorize(df.index.get_level_values(by))
+    else:
+        codes, names = np.zeros(len(df), dtype='int64'), [None]
+    running = df[column].fillna(0).groupby(codes).cummax().to_numpy(dtype='float64')
+    first = np.searchsorted(codes, np.arange(len(names)))
+    peak = np.maximum.reduceat(running, first) if len(running) else np.zeros(0)
+
+    top = max(peak.max() if len(peak) else 0, start)
+    span = 2*top + 1
+    steps = int(np.ceil(np.log2(top / start))) + 1
+    thresholds = start * 2.0**np.arange(steps)
+    series, step = np.nonzero((np.arange(steps) == 0) | (thresholds < peak[:, None]))
+    cases = thresholds[step]
+
+    position = np.searchsorted(running + codes*span, cases + series*span, side='right') - 1
+    found = position >= first[series]
+    position = np.where(found, position, first[series])
+    days = np.where(found, (dates[position] - dates[first[series]]).days, np.nan)
+
+    table = pd.DataFrame({'Cases': cases.astype('int64'), 'Days since first Case': days})
+    if by:
+        table.insert(0, by, np.asarray(names)[series])
+    table = table.set_index([by, 'Cases'] if by else 'Cases')
+    since = table['Days since first Case']
+    table['Doubling Days'] = (since.groupby(level=by).diff() if by else since.diff()).fillna(since)
+    return table
+
+@memoized
+def mortality_rates(df):
+    rates = pd.DataFrame(index=df.index)
+    rates["Mortality Rate"] = df["Deaths"] / df["Confirmed"] * 100
+    rates["Recovery Rate"] = df["Recovered"] / df["Confirmed"] * 100
+    rates["Active Cases"] = df["Confirmed"] - df["Recovered"] - df["Deaths"]
+    rates["Closed Cases"] = df["Recovered"] + df["Deaths"]
+    return rates
+
+@memoized
+def daily_increase(df, by=None, columns=CASES):
+    counts = df[columns]
+    return (counts.groupby(level=by).diff() if by else counts.diff()).fillna(0)
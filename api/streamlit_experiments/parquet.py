@@ -0,0 +1,121 @@
+import pandas as pd
+import os
+import json
+import shutil
+import hashlib
+import logging
+import urllib.request
+
+# Converts the CSV sources the data apps use into typed, compressed Parquet copies. Each
+# copy has a sidecar JSON with the source checksum and conversion options, and is only
+# rebuilt when either changes. Copies are kept under PARQUET_DIR, out of the source tree.
+PARQUET_DIR = os.environ.get('PARQUET_DIR',
+    os.path.join(os.path.expanduser('~'), '.cloud-experiments', 'parquet'))
+# pyarrow skips directories starting with an underscore, so no leading underscore here
+PARTITION_COLUMN = 'partition_period'
+
+def is_url(source):
+    return source.startswith(('http://', 'https://'))
+
+def source_checksum(source):
+    # sha256 of a local file. URLs are not downloaded, their ETag, Last-Modified and size
+    # from a HEAD request stand in for the content.
+    if is_url(source):
+        request = urllib.request.Request(source, method='HEAD')
+        with urllib.request.urlopen(request, timeout=30) as response:
+            headers = response.headers
+            return '|'.join(headers.get(h, '') for h in ('ETag', 'Last-Modified', 'Content-Length'))
+    digest = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _strip_suffixes(name):
+    for suffix in ('.zip', '.gz', '.bz2', '.csv'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+def parquet_path(source):
+    # Named after the source file, with a digest of its URL or absolute path to keep
+    # sources of the same name apart
+    location = source if is_url(source) else os.path.abspath(source)
+    name = _strip_suffixes(os.path.basename(location.split('?')[0]))
+    digest = hashlib.sha256(location.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(PARQUET_DIR, f'{name}-{digest}.parquet')
+
+def _remove(path):
+    # A copy is a file, or a directory when partitioned
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def _sidecar_path(target):
+    return target.rstrip('/') + '.source.json'
+
+def _conversion_options(usecols, dtype, parse_dates, rename, categories, partition_on, partition_freq, read_kwargs):
+    options = {'usecols': usecols, 'dtype': dtype, 'parse_dates': parse_dates, 'rename': rename,
+               'categories': categories, 'partition_on': partition_on, 'partition_freq': partition_freq,
+               'read_kwargs': read_kwargs}
+    return json.loads(json.dumps(options, sort_keys=True, default=str))
+
+def _read_sidecar(target):
+    path = _sidecar_path(target)
+    if not os.path.exists(path) or not os.path.exists(target):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def csv_to_parquet(source, target=None, usecols=None, dtype=None, parse_dates=None, rename=None,
+                   categories=0.5, partition_on=None, partition_freq='M', compression='snappy', **read_kwargs):
+    # Returns the Parquet path, converting only when the source or options changed.
+    # categories converts text columns with fewer distinct values than that share of rows.
+    # partition_on names a date column to partition by, at partition_freq periods.
+    target = target or parquet_path(source)
+    options = _conversion_options(usecols, dtype, parse_dates, rename, categories,
+                                  partition_on, partition_freq, read_kwargs)
+    sidecar = _read_sidecar(target)
+    try:
+        checksum = source_checksum(source)
+    except OSError as e:
+        if sidecar is None:
+            raise
+        # Offline with a copy in place, keep using it
+        logging.warning(f'Could not check {source}, using existing {target}: {e}')
+        return target
+    if sidecar and sidecar['checksum'] == checksum and sidecar['options'] == options:
+        return target
+
+    df = pd.read_csv(source, usecols=usecols, dtype=dtype, parse_dates=parse_dates, low_memory=False, **read_kwargs)
+    if rename:
+        df = df.rename(columns=rename)
+    if categories:
+        for column in df.select_dtypes(['object', 'string']).columns:
+            if df[column].nunique() < categories * len(df):
+                df[column] = df[column].astype('category')
+
+    os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+    staging = target.rstrip('/') + '.tmp'
+    _remove(staging)
+    if partition_on:
+        df[PARTITION_COLUMN] = df[partition_on].dt.to_period(partition_freq).astype(str)
+        df.to_parquet(staging, index=False, compression=compression, partition_cols=[PARTITION_COLUMN])
+    else:
+        df.to_parquet(staging, index=False, compression=compression)
+    _remove(target)
+    os.replace(staging, target)
+
+    with open(_sidecar_path(target), 'w') as f:
+        json.dump({'source': source, 'checksum': checksum, 'options': options, 'rows': len(df)}, f)
+    return target
+
+def read_csv_as_parquet(source, columns=None, filters=None, **kwargs):
+    # Drop-in for pd.read_csv on app sources, reading from the converted copy. filters
+    # prunes partitions, e.g. [('partition_period', '>=', '2020-03')].
+    target = csv_to_parquet(source, **kwargs)
+    df = pd.read_parquet(target, columns=columns, filters=filters)
+    if PARTITION_COLUMN in df.columns:
+        df = df.drop(columns=PARTITION_COLUMN)
+    return df
@@ -3,13 +3,46 @@ import boto3
 import botocore
 import pandas as pd
 import io
+import os
+import re
+import bz2
+import csv
+import json
+import zlib
+import sqlite3
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-s3_client = boto3.client('s3')
-s3_resource = boto3.resource('s3')
+# The S3 client is created on first use and shared by all app sessions.
+# Call configure_client before use to change the region or endpoint.
+client_config = {'region_name': None, 'endpoint_url': None}
+_client = None
+_client_lock = threading.Lock()
+
+def configure_client(region_name=None, endpoint_url=None):
+    global _client
+    with _client_lock:
+        client_config['region_name'] = region_name
+        client_config['endpoint_url'] = endpoint_url
+        _client = None
+
+def s3_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                kwargs = {name: value for name, value in client_config.items() if value is not None}
+                _client = boto3.client('s3', **kwargs)
+    return _client
+
+# Local inventory of bucket listings, one SQLite file per bucket
+INDEX_DIR = os.environ.get('S3_INDEX_DIR',
+    os.path.join(os.path.expanduser('~'), '.cloud-experiments', 's3-index'))
 
 def search_buckets():
     search = st.text_input('Search S3 bucket in your account', '')
-    response = s3_client.list_buckets()
+    response = s3_client().list_buckets()
     if search:
         buckets_found = 0
         for bucket in response['Buckets']:
@@ -25,13 +58,112 @@ def search_buckets():
     else:   
         st.info('Provide string to search for listing buckets')
 
-def list_bucket_contents():
-    total_size_gb = 0
-    total_files = 0
-    match_size_gb = 0
-    match_files = 0
+def index_path(bucket):
+    return os.path.join(INDEX_DIR, bucket + '.sqlite')
+
+def index_connect(bucket):
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    conn = sqlite3.connect(index_path(bucket))
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS objects (
+            key TEXT PRIMARY KEY, prefix TEXT, size INTEGER, etag TEXT, last_modified TEXT);
+        CREATE INDEX IF NOT EXISTS objects_prefix ON objects (prefix);
+        CREATE INDEX IF NOT EXISTS objects_size ON objects (size);
+        CREATE TABLE IF NOT EXISTS prefixes (
+            prefix TEXT PRIMARY KEY, subprefixes TEXT, listed_at REAL);
+    """)
+    return conn
+
+def index_exists(bucket):
+    if not os.path.exists(index_path(bucket)):
+        return False
+    conn = index_connect(bucket)
+    try:
+        return conn.execute('SELECT count(*) FROM prefixes').fetchone()[0] > 0
+    finally:
+        conn.close()
+
+def _index_replace_prefix(conn, prefix, objects, subprefixes):
+    with conn:
+        conn.execute('DELETE FROM objects WHERE prefix = ?', (prefix,))
+        conn.executemany('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)',
+            [(o['Key'], prefix, o['Size'], o.get('ETag', '').strip('"'), str(o.get('LastModified', '')))
+                for o in objects])
+        conn.execute('INSERT OR REPLACE INTO prefixes VALUES (?, ?, ?)',
+            (prefix, json.dumps(subprefixes), time.time()))
+
+def refresh_index(bucket, max_age=3600, full=False, workers=16, progress=None):
+    # The index keeps the objects and common prefixes of every delimiter listing.
+    # A refresh walks the stored prefix tree and re-lists only prefixes that were
+    # listed more than max_age seconds ago (or all of them when full is set).
+    conn = index_connect(bucket)
+    try:
+        listed = {p: (t, json.loads(subprefixes))
+            for p, subprefixes, t in conn.execute('SELECT prefix, subprefixes, listed_at FROM prefixes')}
+        now = time.time()
+
+        def list_prefix(p):
+            if not full and p in listed and now - listed[p][0] <= max_age:
+                return p, None, listed[p][1]
+            objects = []
+            subprefixes = []
+            for page in s3_client().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=p, Delimiter='/'):
+                objects.extend(page.get('Contents', []))
+                subprefixes.extend(cp['Prefix'] for cp in page.get('CommonPrefixes', []))
+            return p, objects, subprefixes
+
+        visited = set()
+        relisted = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {executor.submit(list_prefix, '')}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    p, objects, subprefixes = future.result()
+                    visited.add(p)
+                    if objects is not None:
+                        _index_replace_prefix(conn, p, objects, subprefixes)
+                        relisted += 1
+                    pending |= {executor.submit(list_prefix, sub) for sub in subprefixes}
+                if progress:
+                    progress(relisted, len(visited))
+
+        # Prefixes no longer reachable from the root were removed from the bucket
+        with conn:
+            for p in set(listed) - visited:
+                conn.execute('DELETE FROM objects WHERE prefix = ?', (p,))
+                conn.execute('DELETE FROM prefixes WHERE prefix = ?', (p,))
+        return relisted, len(visited)
+    finally:
+        conn.close()
+
+def query_index(bucket, match='', size_mb=0, prefix=''):
+    conditions = []
+    params = []
+    if prefix:
+        conditions.append('key >= ? AND key < ?')
+        params.extend([prefix, prefix + '\uffff'])
+    if match:
+        conditions.append('instr(key, ?) > 0')
+        params.append(match)
+    if size_mb:
+        conditions.append('size <= ?')
+        params.append(size_mb*1024*1024)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+    conn = index_connect(bucket)
+    try:
+        df = pd.read_sql_query('SELECT key AS Key, size AS Size, etag AS ETag, last_modified AS LastModified '
+            'FROM objects' + where + ' ORDER BY key', conn, params=params)
+        files, total_bytes = conn.execute('SELECT count(*), coalesce(sum(size), 0) FROM objects').fetchone()
+    finally:
+        conn.close()
+    df.insert(1, 'SizeMB', df['Size']/1024/1024)
+    totals = {'files': files, 'bytes': total_bytes, 'match_bytes': int(df['Size'].sum())}
+    return totals, df.drop(columns=['Size'])
+
+def list_bucket_contents(page_size=100):
     bucket = st.text_input('S3 bucket name (public bucket or private to your account)', '')
-    bucket_resource = s3_resource.Bucket(bucket)
     match = st.text_input('(optional) Filter bucket contents with matching string', '')
     size_mb = st.text_input('(optional) Match files up to size in MB (0 for all sizes)', '0')
     if size_mb:
@@ -40,28 +172,29 @@ def list_bucket_contents():
         size_mb = 0
 
     if bucket:
-        for key in bucket_resource.objects.all():
-            key_size_mb = key.size/1024/1024
-            total_size_gb += key_size_mb
-            total_files += 1
-            list_check = False
-            if not match:
-                list_check = True
-            elif match in key.key:
-                list_check = True
-            if list_check and not size_mb:
-                match_files += 1
-                match_size_gb += key_size_mb
-                st.write(f'{key.key} ({key_size_mb:3.0f}MB)')
-            elif list_check and key_size_mb <= size_mb:
-                match_files += 1
-                match_size_gb += key_size_mb
-                st.write(f'{key.key} ({key_size_mb:3.0f}MB)')
+        # Every load re-lists only the prefixes listed more than max_age ago, the button
+        # re-lists the whole bucket
+        rebuild = st.button('Rebuild bucket index')
+        progress = st.empty()
+        relisted, prefixes = refresh_index(bucket, full=rebuild,
+            progress=lambda relisted, visited: progress.text(f'Listed {relisted} of {visited} prefixes'))
+        progress.empty()
+        if relisted:
+            st.write(f'Indexed bucket **{bucket}** ({relisted} of {prefixes} prefixes listed)')
+
+        totals, df = query_index(bucket, match, size_mb)
+
+        if len(df) > page_size:
+            pages = (len(df) - 1) // page_size + 1
+            page = st.number_input(f'Page (of {pages})', min_value=1, max_value=pages, value=1)
+            st.dataframe(df.iloc[(page - 1)*page_size:page*page_size])
+        else:
+            st.dataframe(df)
 
         if match:
-            st.info(f'Matched file size is **{match_size_gb/1024:3.1f}GB** with **{match_files}** files')            
-        
-        st.success(f'Bucket **{bucket}** total size is **{total_size_gb/1024:3.1f}GB** with **{total_files}** files')
+            st.info(f'Matched file size is **{totals["match_bytes"]/1024/1024/1024:3.1f}GB** with **{len(df)}** files')
+
+        st.success(f'Bucket **{bucket}** total size is **{totals["bytes"]/1024/1024/1024:3.1f}GB** with **{totals["files"]}** files')
     else:
         st.info('Provide bucket name to list contents')
 
@@ -69,7 +202,7 @@ def create_bucket():
     bucket = st.text_input('S3 bucket name to create', '')
     if bucket:
         try:
-            s3_client.create_bucket(Bucket=bucket)
+            s3_client().create_bucket(Bucket=bucket)
         except botocore.exceptions.ClientError as e:
             st.error('Bucket **' + bucket + '** could not be created. ' + e.response['Error']['Message'])
             return
@@ -77,29 +210,107 @@ def create_bucket():
     else:
         st.info('Provide unique bucket name to create')
 
+SELECT_INPUT_FORMATS = {
+    'csv': {'CSV': {'FileHeaderInfo': 'Use'}},
+    'csv.gz': {'CSV': {'FileHeaderInfo': 'Use'}, 'CompressionType': 'GZIP'},
+    'csv.bz2': {'CSV': {'FileHeaderInfo': 'Use'}, 'CompressionType': 'BZIP2'},
+    'parquet': {'Parquet': {}},
+}
+
+def select_input_format(key):
+    for suffix in ['.csv.gz', '.csv.bz2', '.parquet']:
+        if key.lower().endswith(suffix):
+            return suffix[1:]
+    return 'csv'
+
+def select_column_names(statement):
+    # Column names S3 Select gives the projection: the alias, the column
+    # name without the table alias, or _N for expressions. None for SELECT * and SELECT s.*.
+    projection = re.match(r'\s*select\s+(.*?)\s+from\s', statement, re.IGNORECASE | re.DOTALL)
+    if not projection or re.fullmatch(r'(?:\w+\.)?\*', projection.group(1).strip()):
+        return None
+    items = re.split(r',(?![^(]*\))', projection.group(1))
+    columns = []
+    for i, item in enumerate(items, 1):
+        item = item.strip()
+        alias = re.search(r'\s+as\s+"?(\w+)"?$', item, re.IGNORECASE)
+        name = re.fullmatch(r'(?:\w+\.)?"?(\w+)"?', item)
+        if alias:
+            columns.append(alias.group(1))
+        elif name:
+            columns.append(name.group(1))
+        else:
+            columns.append(f'_{i}')
+    return columns
+
+def csv_header(bucket, key, input_format='csv'):
+    body = s3_client().get_object(Bucket=bucket, Key=key, Range='bytes=0-65535')['Body'].read()
+    if input_format == 'csv.gz':
+        body = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(body)
+    elif input_format == 'csv.bz2':
+        body = bz2.BZ2Decompressor().decompress(body)
+    if b'\n' not in body:
+        return None
+    line = body.split(b'\n', 1)[0].rstrip(b'\r').decode('utf-8')
+    return next(csv.reader([line]))
+
+def _parse_select(data, output='json', columns=None):
+    if output == 'json':
+        return pd.read_json(io.BytesIO(data), lines=True)
+    if not data.strip():
+        return pd.DataFrame(columns=columns or [])
+    df = pd.read_csv(io.BytesIO(data), header=None)
+    if not columns or len(columns) != len(df.columns):
+        columns = [f'_{i}' for i in range(1, len(df.columns) + 1)]
+    df.columns = columns
+    return df
+
+def s3_select_payload(bucket, key, sql, input_format='csv', output='json'):
+    s3_select_results = s3_client().select_object_content(
+        Bucket=bucket,
+        Key=key,
+        Expression=sql,
+        ExpressionType='SQL',
+        InputSerialization=SELECT_INPUT_FORMATS[input_format],
+        OutputSerialization={'JSON': {}} if output == 'json' else {'CSV': {}},
+        RequestProgress={'Enabled': True},
+    )
+
+    stats = st.empty()
+    for event in s3_select_results['Payload']:
+        if 'Records' in event:
+            yield event['Records']['Payload']
+        elif 'Progress' in event or 'Stats' in event:
+            details = (event.get('Progress') or event['Stats'])['Details']
+            stats.write(f"Scanned: {int(details['BytesScanned'])/1024/1024:5.2f}MB  "
+                        f"Processed: {int(details['BytesProcessed'])/1024/1024:5.2f}MB  "
+                        f"Returned: {int(details['BytesReturned'])/1024/1024:5.2f}MB")
+
 def s3_select():
     bucket = st.text_input('S3 bucket name', '')
-    csv = st.text_input('CSV File path and name', '')
+    csv = st.text_input('CSV or Parquet file path and name', '')
+    input_format = st.selectbox('Input format', ['auto'] + list(SELECT_INPUT_FORMATS))
+    output = st.radio('Output format', ['csv', 'json'])
     st.write("Example: `SELECT * FROM s3object s LIMIT 5`")
     sql = st.text_area('SQL statement', '')
     if bucket and csv and sql:
-        s3_select_results = s3_client.select_object_content(
-            Bucket=bucket,
-            Key=csv,
-            Expression=sql,
-            ExpressionType='SQL',
-            InputSerialization={'CSV': {"FileHeaderInfo": "Use"}},
-            OutputSerialization={'JSON': {}},
-        )
-
-        for event in s3_select_results['Payload']:
-            if 'Records' in event:
-                df = pd.read_json(io.StringIO(event['Records']['Payload'].decode('utf-8')), lines=True)
-            elif 'Stats' in event:
-                st.write(f"Scanned: {int(event['Stats']['Details']['BytesScanned'])/1024/1024:5.2f}MB")            
-                st.write(f"Processed: {int(event['Stats']['Details']['BytesProcessed'])/1024/1024:5.2f}MB")
-                st.write(f"Returned: {int(event['Stats']['Details']['BytesReturned'])/1024/1024:5.2f}MB")
-        
+        if input_format == 'auto':
+            input_format = select_input_format(csv)
+        columns = None
+        if output != 'json':
+            columns = select_column_names(sql)
+            if columns is None and input_format.startswith('csv'):
+                columns = csv_header(bucket, csv, input_format)
+            if columns is None:
+                # No header to name the columns of a Parquet SELECT *, JSON keeps the names
+                output = 'json'
+                st.info('Column names unknown for CSV output, using JSON output')
+
+        buffer = io.BytesIO()
+        for payload in s3_select_payload(bucket, csv, sql, input_format, output):
+            buffer.write(payload)
+        df = _parse_select(buffer.getvalue(), output, columns)
+
         st.write(df)
     else:
-        st.info('Provide S3 bucket, CSV file name, and SQL statement')
\ No newline at end of file
+        st.info('Provide S3 bucket, CSV file name, and SQL statement')
@@ -4,12 +4,12 @@
 # 3. Use Altair (https://altair-viz.github.io/) declarative statistical visualization charts
 
 import datetime
-from functools import reduce
 import streamlit as st
 from streamlit import caching
 import pandas as pd
 import altair as alt
 import os
+from api.streamlit_experiments import covid_jhu as jhu
 
 # numbers for 2019
 inhabitants = {'India': 1352.6,
@@ -20,39 +20,11 @@ inhabitants = {'India': 1352.6,
             'China': 1392.7,
             'Italy': 60.23}
 
-@st.cache
+@st.cache(ttl=3600)
 def read_data():
-    BASEURL = "https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series"    
-    url_confirmed = f"{BASEURL}/time_series_covid19_confirmed_global.csv"
-    url_deaths = f"{BASEURL}/time_series_covid19_deaths_global.csv"
-    url_recovered = f"{BASEURL}/time_series_covid19_recovered_global.csv"
-
-    confirmed = pd.read_csv(url_confirmed, index_col=0)
-    deaths = pd.read_csv(url_deaths, index_col=0)
-    recovered = pd.read_csv(url_recovered, index_col=0)
-
-    # sum over potentially duplicate rows (France and their territories)
-    confirmed = confirmed.groupby("Country/Region").sum().reset_index()
-    deaths = deaths.groupby("Country/Region").sum().reset_index()
-    recovered = recovered.groupby("Country/Region").sum().reset_index()
-
-    return (confirmed, deaths, recovered)
-
-def transform(df, collabel='confirmed'):
-    dfm = pd.melt(df)
-    dfm["date"] = pd.to_datetime(dfm.variable, infer_datetime_format=True)
-    dfm = dfm.set_index("date")
-    dfm = dfm[["value"]]
-    dfm.columns = [collabel]
-    return dfm
-
-def transform2(df, collabel='confirmed'):
-    dfm = pd.melt(df, id_vars=["Country/Region"])
-    dfm["date"] = pd.to_datetime(dfm.variable, infer_datetime_format=True)
-    dfm = dfm.set_index("date")
-    dfm = dfm[["Country/Region","value"]]
-    dfm.columns = ["country", collabel]
-    return dfm
+    # Local long-format store, refreshed incrementally from JHU (or the JHU_MIRROR directory),
+    # as one table of confirmed, deaths and recovered indexed by (country, date)
+    return jhu.long_table(jhu.refresh())
 
 def app():
     st.title("🦠 Covid-19 Data Explorer")
@@ -80,26 +52,21 @@ def app():
             ℹ️ You can select/ deselect countries and switch between linear and log scales.
             """)
 
-        confirmed, deaths, recovered = read_data()
+        cases = read_data()
 
         multiselection = st.multiselect("Select countries:", countries, default=countries)
         logscale = st.checkbox("Log scale", False)
 
-        confirmed = confirmed[confirmed["Country/Region"].isin(multiselection)]
-        confirmed = confirmed.drop(["Lat", "Long"],axis=1)
-        confirmed = transform2(confirmed, collabel="confirmed")
-
-        deaths = deaths[deaths["Country/Region"].isin(multiselection)]
-        deaths = deaths.drop(["Lat", "Long"],axis=1)
-        deaths = transform2(deaths, collabel="deaths")
-
-        frate = confirmed[["country"]]
-        frate["frate"] = (deaths.deaths / confirmed.confirmed)*100
-
         # saveguard for empty selection 
         if len(multiselection) == 0:
             return 
 
+        selected = cases.loc[multiselection]
+        confirmed = selected[["confirmed"]].reset_index("country")
+
+        frate = confirmed[["country"]].copy()
+        frate["frate"] = (selected.deaths / selected.confirmed).to_numpy()*100
+
         SCALE = alt.Scale(type='linear')
         if logscale:
             confirmed["confirmed"] += 0.00001
@@ -154,7 +121,7 @@ def app():
 
     elif analysis == "By Country":        
 
-        confirmed, deaths, recovered = read_data()
+        cases = read_data()
 
         st.header("Country statistics")
         st.markdown("""\
@@ -170,17 +137,7 @@ def app():
         cummulative = st.radio("Display type:", ["total", "new cases"])
         #scaletransform = st.radio("Plot y-axis", ["linear", "pow"])
         
-        confirmed = confirmed[confirmed["Country/Region"] == selection].iloc[:,3:]
-        confirmed = transform(confirmed, collabel="confirmed")
-
-        deaths = deaths[deaths["Country/Region"] == selection].iloc[:,3:]
-        deaths = transform(deaths, collabel="deaths")
-
-        recovered = recovered[recovered["Country/Region"] == selection].iloc[:,3:]
-        recovered = transform(recovered, collabel="recovered")
-
-        
-        df = reduce(lambda a,b: pd.merge(a,b, on='date'), [confirmed, recovered, deaths])
+        df = cases.loc[selection, ["confirmed", "recovered", "deaths"]].copy()
         df["active"] = df.confirmed - (df.deaths + df.recovered)
 
         variables = ["recovered", "active", "deaths"]
@@ -191,7 +148,7 @@ def app():
         if cummulative == 'new cases':
             value_vars = ["new"]
             df["new"] = df.confirmed - df.shift(1).confirmed
-            df["new"].loc[df.new < 0]  = 0
+            df.loc[df.new < 0, "new"] = 0
             SCALE = alt.Scale(domain=["new"], range=["orange"]) 
 
         dfm = pd.melt(df.reset_index(), id_vars=["date"], value_vars=value_vars)
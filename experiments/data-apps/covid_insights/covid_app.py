@@ -1,41 +1,27 @@
 import streamlit as st
-import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from api.streamlit_experiments import covid as cov
+from api.streamlit_experiments import covid_data
 
 st.title('COVID Exploratory Data Analysis')
 
 # Data from https://www.kaggle.com/sudalairajkumar/novel-corona-virus-2019-dataset?select=covid_19_data.csv
 
-covid = pd.read_csv('494724_1196190_compressed_covid_19_data.csv.zip')
-
-# Dropping column as SNo is of no use, and 'Province/State' contains too many missing values
-covid.drop(['SNo'], 1, inplace=True)
+# Country x date cube, cached across reruns and rebuilt only when the file changes.
+# SNo is of no use, and 'Province/State' contains too many missing values
+data = covid_data.load_cube('494724_1196190_compressed_covid_19_data.csv.zip')
+covid = data['raw']
 
 st.header('Dataset')
 st.write(covid)
 
-# Converting 'Observation Date' into Datetime format
-covid['ObservationDate']=pd.to_datetime(covid['ObservationDate'])
-
-# Grouping different types of cases as per the date
-datewise = covid.groupby(['ObservationDate']).agg({
-    'Confirmed': 'sum',
-    'Recovered': 'sum',
-    'Deaths': 'sum'
-    })
-
-datewise['Days Since'] = datewise.index-datewise.index.min()
-datewise["WeekOfYear"]=datewise.index.weekofyear
-
-india_data=covid[covid["Country/Region"]=="India"]
-datewise_india=india_data.groupby(["ObservationDate"]).agg({"Confirmed":'sum',"Recovered":'sum',"Deaths":'sum'})
-datewise_india['Days Since'] = datewise_india.index-datewise.index.min()
-datewise_india["WeekOfYear"]=datewise_india.index.weekofyear
+# Different types of cases as per the date, for the world and for India
+datewise = data['world']
+datewise_india = covid_data.country(data, 'India')
 
 st.header('Global Analysis')
 
@@ -70,10 +56,8 @@ cov.daily_increase(datewise)
 
 st.header('Countrywise Analysis')
 
-#Calculating countrywise Mortality and Recovery Rate
-countrywise=covid[covid["ObservationDate"]==covid["ObservationDate"].max()].groupby(["Country/Region"]).agg({"Confirmed":'sum',"Recovered":'sum',"Deaths":'sum'}).sort_values(["Confirmed"],ascending=False)
-countrywise["Mortality"]=(countrywise["Deaths"]/countrywise["Confirmed"])*100
-countrywise["Recovery"]=(countrywise["Recovered"]/countrywise["Confirmed"])*100
+#Countrywise Mortality and Recovery Rate
+countrywise=data['countrywise']
 
 fig, (ax1, ax2) = plt.subplots(2, 1,figsize=(10,12))
 top_15_confirmed=countrywise.sort_values(["Confirmed"],ascending=False).head(15)
@@ -104,12 +88,9 @@ cov.mortality(datewise_india)
 
 st.subheader('India Compared with Other Countries')
 
-Italy_data=covid[covid["Country/Region"]=="Italy"]
-US_data=covid[covid["Country/Region"]=="US"]
-spain_data=covid[covid["Country/Region"]=="Spain"]
-datewise_Italy=Italy_data.groupby(["ObservationDate"]).agg({"Confirmed":'sum',"Recovered":'sum',"Deaths":'sum'})
-datewise_US=US_data.groupby(["ObservationDate"]).agg({"Confirmed":'sum',"Recovered":'sum',"Deaths":'sum'})
-datewise_Spain=spain_data.groupby(["ObservationDate"]).agg({"Confirmed":'sum',"Recovered":'sum',"Deaths":'sum'})
+datewise_Italy=covid_data.country(data, "Italy")
+datewise_US=covid_data.country(data, "US")
+datewise_Spain=covid_data.country(data, "Spain")
 
 max_ind=datewise_india["Confirmed"].max()
 fig = plt.figure(figsize=(12,6))
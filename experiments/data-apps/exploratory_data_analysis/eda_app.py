@@ -1,11 +1,12 @@
 import streamlit as st
-import pandas as pd
 from api.streamlit_experiments import eda
+from api.streamlit_experiments import parquet
 
 st.header('Exploratory Data Analysis App')
 
 st.subheader('Dataset')
-df = pd.read_csv('census-income.csv')
+# Loaded from a Parquet copy, converted again only when the CSV changes
+df = parquet.read_csv_as_parquet('census-income.csv')
 st.write(df.head(20))
 
 st.write(f'Rows, Columns: {df.shape}')
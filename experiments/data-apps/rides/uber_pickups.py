@@ -1,6 +1,6 @@
 import streamlit as st
-import pandas as pd
 import numpy as np
+from api.streamlit_experiments import parquet
 
 st.title('Uber pickups in NYC')
 
@@ -10,10 +10,11 @@ DATA_URL = ('https://s3-us-west-2.amazonaws.com/'
 
 @st.cache
 def load_data(nrows):
-    data = pd.read_csv(DATA_URL, nrows=nrows)
-    lowercase = lambda x: str(x).lower()
-    data.rename(lowercase, axis='columns', inplace=True)
-    data[DATE_COLUMN] = pd.to_datetime(data[DATE_COLUMN])
+    # Parquet copy keyed on the URL's ETag, with lowercase names and parsed dates, so
+    # reruns skip the download and the CSV parse
+    data = parquet.read_csv_as_parquet(DATA_URL, nrows=nrows, parse_dates=['Date/Time'],
+        rename={'Date/Time': DATE_COLUMN, 'Lat': 'lat', 'Lon': 'lon', 'Base': 'base'},
+        partition_on=DATE_COLUMN, partition_freq='D')
     return data
 
 # Create a text element and let the reader know the data is loading.
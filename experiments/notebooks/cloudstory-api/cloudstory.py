@@ -1,35 +1,109 @@
 import boto3
 import botocore
+import botocore.config
+from boto3.s3.transfer import TransferConfig
 import pandas as pd
 import numpy as np
 import io
+import os
+import re
+import bz2
+import csv
 import json
+import zlib
+import hashlib
 import time
+import random
+import asyncio
 import logging
-import seaborn as sns
-import matplotlib.pyplot as plt
-from IPython.display import display, Markdown, Image, HTML
-from wordcloud import WordCloud
-
-s3 = boto3.client('s3')
-s3_resource = boto3.resource('s3')
-glue = boto3.client('glue')
-athena = boto3.client('athena')
-rekognition = boto3.client('rekognition','us-east-1')
-comprehend = boto3.client('comprehend', 'us-east-1')
+import functools
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Clients are created on first use and shared by all threads. Call configure_clients
+# before use to change the region, the endpoint (for example a local stand-in) or the
+# botocore Config. The default Config pools enough connections for the 16 worker thread
+# pools used below; aws_client(service, pool=n) gives a client with a larger pool.
+CLIENT_POOL_CONNECTIONS = 32
+# Regions for services when neither configure_clients nor a per-service override sets one
+DEFAULT_SERVICE_REGIONS = {'rekognition': 'us-east-1', 'comprehend': 'us-east-1'}
+client_config = {
+    'region_name': None,
+    'endpoint_url': None,
+    'config': botocore.config.Config(max_pool_connections=CLIENT_POOL_CONNECTIONS),
+    'services': {},
+}
+_clients = {}
+_clients_lock = threading.Lock()
+
+def configure_clients(region_name=None, endpoint_url=None, config=None, **services):
+    # services maps a service name to its own client arguments, e.g. s3={'endpoint_url': ...}.
+    # config (a botocore.config.Config) is merged over the default pool size.
+    with _clients_lock:
+        client_config['region_name'] = region_name
+        client_config['endpoint_url'] = endpoint_url
+        client_config['config'] = botocore.config.Config(max_pool_connections=CLIENT_POOL_CONNECTIONS)
+        if config is not None:
+            client_config['config'] = client_config['config'].merge(config)
+        for service, kwargs in services.items():
+            client_config['services'][service] = kwargs
+        _clients.clear()
+
+def _client_kwargs(service, pool=None):
+    kwargs = {'region_name': client_config['region_name'] or DEFAULT_SERVICE_REGIONS.get(service),
+              'endpoint_url': client_config['endpoint_url']}
+    overrides = dict(client_config['services'].get(service, {}))
+    config = client_config['config']
+    if overrides.get('config') is not None:
+        config = config.merge(overrides.pop('config'))
+    if pool and pool > (config.max_pool_connections or 10):
+        config = config.merge(botocore.config.Config(max_pool_connections=pool))
+    kwargs.update(overrides)
+    kwargs['config'] = config
+    return {name: value for name, value in kwargs.items() if value is not None}
+
+def _memoized_client(kind, service, pool=None):
+    key = (kind, service) if pool is None else (kind, service, pool)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                factory = boto3.client if kind == 'client' else boto3.resource
+                client = _clients[key] = factory(service, **_client_kwargs(service, pool))
+    return client
+
+def aws_client(service, pool=None):
+    # pool asks for a client whose connection pool holds at least that many connections
+    if pool is not None and pool <= client_config['config'].max_pool_connections:
+        pool = None
+    return _memoized_client('client', service, pool)
+
+def aws_resource(service):
+    return _memoized_client('resource', service)
+
+def __getattr__(name):
+    # Keep cloudstory.s3, cloudstory.athena and friends working without creating them at import
+    if name == 's3_resource':
+        return aws_resource('s3')
+    if name in ('s3', 'glue', 'athena', 'rekognition', 'comprehend'):
+        return aws_client(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Function library from https://github.com/aws-samples/aws-open-data-analytics-notebooks/tree/master/exploring-data
 
 def create_bucket(bucket):
     try:
-        s3.create_bucket(Bucket=bucket)
+        aws_client('s3').create_bucket(Bucket=bucket)
     except botocore.exceptions.ClientError as e:
         logging.error(e)
         return 'Bucket ' + bucket + ' could not be created.'
     return 'Created or already exists ' + bucket + ' bucket.'
 
 def list_buckets(match=''):
-    response = s3.list_buckets()
+    response = aws_client('s3').list_buckets()
     if match:
         print(f'Existing buckets containing "{match}" string:')
     else:
@@ -39,34 +113,71 @@ def list_buckets(match=''):
             if match in bucket["Name"]:
                 print(f'  {bucket["Name"]}')
 
-def list_bucket_contents(bucket, match='', size_mb=0):
-    bucket_resource = s3_resource.Bucket(bucket)
-    total_size_gb = 0
+def iter_bucket_pages(bucket, prefix='', delimiter='/', workers=16):
+    # Every prefix is listed with the delimiter on the thread pool and the common
+    # prefixes found in its pages are submitted as new tasks, so the keyspace is
+    # walked concurrently and pages are yielded as soon as any worker receives one.
+    pages = queue.Queue()
+    stop = threading.Event()
+
+    def list_prefix(p):
+        try:
+            for page in aws_client('s3').get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=p, Delimiter=delimiter):
+                if stop.is_set():
+                    break
+                pages.put((page.get('Contents', []), [cp['Prefix'] for cp in page.get('CommonPrefixes', [])], None))
+        except Exception as e:
+            pages.put(([], [], e))
+        finally:
+            pages.put(None)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            executor.submit(list_prefix, prefix)
+            pending = 1
+            while pending:
+                item = pages.get()
+                if item is None:
+                    pending -= 1
+                    continue
+                objects, prefixes, error = item
+                if error:
+                    raise error
+                for p in prefixes:
+                    executor.submit(list_prefix, p)
+                    pending += 1
+                if objects:
+                    yield objects
+        finally:
+            stop.set()
+
+def list_bucket_contents(bucket, match='', size_mb=0, prefix='', workers=16):
+    total_bytes = 0
     total_files = 0
-    match_size_gb = 0
-    match_files = 0
-    for key in bucket_resource.objects.all():
-        key_size_mb = key.size/1024/1024
-        total_size_gb += key_size_mb
-        total_files += 1
-        list_check = False
-        if not match:
-            list_check = True
-        elif match in key.key:
-            list_check = True
-        if list_check and not size_mb:
-            match_files += 1
-            match_size_gb += key_size_mb
-            print(f'{key.key} ({key_size_mb:3.0f}MB)')
-        elif list_check and key_size_mb <= size_mb:
-            match_files += 1
-            match_size_gb += key_size_mb
-            print(f'{key.key} ({key_size_mb:3.0f}MB)')
+    match_bytes = 0
+    keys = []
+    sizes = []
+    for page in iter_bucket_pages(bucket, prefix=prefix, workers=workers):
+        for obj in page:
+            total_bytes += obj['Size']
+            total_files += 1
+            if match and match not in obj['Key']:
+                continue
+            if size_mb and obj['Size'] > size_mb*1024*1024:
+                continue
+            keys.append(obj['Key'])
+            sizes.append(obj['Size'])
+            match_bytes += obj['Size']
+        print(f'Listed {total_files:,} files ({total_bytes/1024/1024/1024:3.1f}GB), matched {len(keys):,}', end='\r')
+    print()
 
     if match:
-        print(f'Matched file size is {match_size_gb/1024:3.1f}GB with {match_files} files')            
-    
-    print(f'Bucket {bucket} total size is {total_size_gb/1024:3.1f}GB with {total_files} files')
+        print(f'Matched file size is {match_bytes/1024/1024/1024:3.1f}GB with {len(keys)} files')
+
+    print(f'Bucket {bucket} total size is {total_bytes/1024/1024/1024:3.1f}GB with {total_files} files')
+
+    df = pd.DataFrame({'Key': keys, 'SizeMB': np.array(sizes, dtype='int64')/1024/1024})
+    return df.sort_values('Key', ignore_index=True)
 
 def preview_csv_dataset(bucket, key, rows=10):
     data_source = {
@@ -74,7 +185,7 @@ def preview_csv_dataset(bucket, key, rows=10):
             'Key': key
         }
     # Generate the URL to get Key from Bucket
-    url = s3.generate_presigned_url(
+    url = aws_client('s3').generate_presigned_url(
         ClientMethod = 'get_object',
         Params = data_source
     )
@@ -82,93 +193,1202 @@ def preview_csv_dataset(bucket, key, rows=10):
     data = pd.read_csv(url, nrows=rows)
     return data
 
-def key_exists(bucket, key):
+# Streaming profile of a CSV object. The object is read in ranged chunks and per column
+# statistics are updated chunk by chunk, so memory stays constant whatever the file size.
+# Distinct counts use a k minimum values sketch over 64 bit hashes.
+
+def _sketch_update(sketch, values, size):
+    hashes = pd.util.hash_pandas_object(values, index=False).to_numpy()
+    return np.unique(np.concatenate([sketch, hashes]))[:size]
+
+def _sketch_estimate(sketch, size):
+    if len(sketch) < size:
+        return len(sketch)
+    return int((size - 1) / (float(sketch[size - 1]) / 2.0**64))
+
+def _histogram_update(column, data):
+    # Edges start from the head sample's range, or the first values seen. Values outside
+    # them double the bin width, merging neighbouring bins, until the edges cover them, so
+    # counts stay exact and nothing is clipped into the end bins.
+    data = data[np.isfinite(data)]
+    if not len(data):
+        return
+    low, high = data.min(), data.max()
+    bins = len(column['histogram'])
+    if column['edges'] is None:
+        column['edges'] = np.linspace(low, high if high > low else low + 1, bins + 1)
+    edges, histogram = column['edges'], column['histogram']
+    while low < edges[0] or high > edges[-1]:
+        width = 2 * (edges[1] - edges[0])
+        left = low < edges[0]
+        padded = np.concatenate([[0], histogram] if left else [histogram, [0]]) if bins % 2 else histogram
+        merged = padded.reshape(-1, 2).sum(axis=1)
+        empty = np.zeros(bins - len(merged), dtype='int64')
+        if left:
+            histogram = np.concatenate([empty, merged])
+            edges = edges[-1] - width * np.arange(bins, -1, -1)
+        else:
+            histogram = np.concatenate([merged, empty])
+            edges = edges[0] + width * np.arange(bins + 1)
+    column['edges'] = edges
+    column['histogram'] = histogram + np.histogram(data, edges)[0]
+
+def _profile_chunk(stats, df, numeric):
+    for name in df.columns:
+        column = stats[name]
+        values = df[name]
+        if name in numeric:
+            values = pd.to_numeric(values, errors='coerce')
+        present = values.dropna()
+        column['count'] += len(values)
+        column['nulls'] += len(values) - len(present)
+        if not len(present):
+            continue
+        if name in numeric:
+            data = present.to_numpy(dtype='float64')
+            column['sum'] += data.sum()
+            column['sumsq'] += np.square(data).sum()
+            _histogram_update(column, data)
+        else:
+            present = present.astype(str)
+        low, high = present.min(), present.max()
+        column['min'] = low if column['min'] is None else min(column['min'], low)
+        column['max'] = high if column['max'] is None else max(column['max'], high)
+        column['sketch'] = _sketch_update(column['sketch'], present, column['sketch_size'])
+
+def _profile_snapshot(stats, numeric):
+    # Null fractions and numeric means, compared between chunks to detect convergence
+    snapshot = [column['nulls'] / max(column['count'], 1) for column in stats.values()]
+    snapshot += [stats[name]['sum'] / max(stats[name]['count'] - stats[name]['nulls'], 1) for name in numeric]
+    return np.array(snapshot)
+
+PROFILE_LINE_KB = 64
+
+def _read_lines(bucket, key, offset, end, size):
+    # Bytes of the lines starting in [offset, end). The range starts one byte early to see
+    # whether offset begins a line, and runs PROFILE_LINE_KB past end to finish the last
+    # line, reading further ranges when that line is longer.
+    s3 = aws_client('s3')
+    start = max(offset - 1, 0)
+    stop = min(end + PROFILE_LINE_KB*1024, size)
+    body = s3.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{stop - 1}')['Body'].read()
+    while stop < size and body.find(b'\n', end - 1 - start) < 0:
+        more = min(stop + max(stop - end, PROFILE_LINE_KB*1024), size)
+        body += s3.get_object(Bucket=bucket, Key=key, Range=f'bytes={stop}-{more - 1}')['Body'].read()
+        stop = more
+    first = 0
+    if offset > 0:
+        first = body.find(b'\n', 0, end - start - 1) + 1
+        if not first:
+            return b'', len(body)
+    last = len(body)
+    if end < size:
+        newline = body.find(b'\n', end - 1 - start)
+        if newline >= 0:
+            last = newline + 1
+    return body[first:last], len(body)
+
+def _spread_order(chunks):
+    # 0, s, 2s, ... then 1, s + 1, ... so any prefix of the order is spread over the object
+    stride = max(int(np.ceil(np.sqrt(chunks))), 1)
+    return [i for r in range(stride) for i in range(r, chunks, stride)]
+
+def profile_csv_dataset(bucket, key, chunk_mb=8, sample_rows=10000, max_mb=None, bins=20,
+                        tol=0.01, patience=3, sketch_size=1024):
+    # Chunks are read in an order spread across the object, so stopping early (max_mb, or
+    # once null fractions and means change by less than tol for patience consecutive chunks)
+    # still samples the whole file, sorted data included. Counts are then scaled up to the
+    # object and SampledPct shows the share read; Min, Max, Distinct and Histogram describe
+    # the sampled rows. max_mb counts the chunk bytes profiled, not the look-ahead read to
+    # finish their last lines. Histogram counts values in bins over HistogramRange, None
+    # for numeric columns without values. Fields with embedded newlines are not supported.
+    size = aws_client('s3').head_object(Bucket=bucket, Key=key)['ContentLength']
+    limit = size if max_mb is None else min(size, int(max_mb*1024*1024))
+    chunk = int(chunk_mb*1024*1024)
+    columns = None
+    numeric = []
+    stats = {}
+    read = 0
+    covered = 0
+    rows = 0
+    stable = 0
+    previous = None
+    for index in _spread_order(int(np.ceil(size / chunk))):
+        if covered >= limit:
+            break
+        offset = index*chunk
+        end = min(offset + chunk, size)
+        data, length = _read_lines(bucket, key, offset, end, size)
+        read += length
+        covered += end - offset
+
+        if columns is None:
+            header, _, data = data.partition(b'\n')
+            columns = next(csv.reader([header.decode('utf-8').rstrip('\r')]))
+            sample = pd.read_csv(io.BytesIO(data), header=None, names=columns, nrows=sample_rows)
+            numeric = list(sample.select_dtypes('number').columns)
+            for name in columns:
+                stats[name] = {'count': 0, 'nulls': 0, 'min': None, 'max': None, 'sum': 0.0, 'sumsq': 0.0,
+                               'sketch': np.empty(0, dtype='uint64'), 'sketch_size': sketch_size}
+            for name in numeric:
+                low, high = sample[name].min(), sample[name].max()
+                stats[name]['edges'] = None if pd.isna(low) else np.linspace(low, high if high > low else low + 1, bins + 1)
+                stats[name]['histogram'] = np.zeros(bins, dtype='int64')
+
+        if not data.strip():
+            continue
+        df = pd.read_csv(io.BytesIO(data), header=None, names=columns, low_memory=False)
+        rows += len(df)
+        _profile_chunk(stats, df, numeric)
+
+        snapshot = _profile_snapshot(stats, numeric)
+        if previous is not None and np.all(np.abs(snapshot - previous) <= tol*np.maximum(np.abs(previous), 1e-12)):
+            stable += 1
+        else:
+            stable = 0
+        previous = snapshot
+        if stable >= patience:
+            break
+
+    converged = stable >= patience
+    sampled = covered / max(size, 1) if size else 1
+    if sampled < 1:
+        print(f'Profiled {rows:,} rows from {100*sampled:.0f}% of {size/1024/1024:,.1f}MB'
+              + (' (statistics converged)' if converged else '')
+              + f', counts estimated for the whole object, Min, Max, Distinct and Histogram from the sample')
+    else:
+        print(f'Profiled {rows:,} rows from {read/1024/1024:,.1f}MB of {size/1024/1024:,.1f}MB')
+
+    profile = []
+    for name, column in stats.items():
+        present = column['count'] - column['nulls']
+        mean = column['sum'] / present if name in numeric and present else None
+        std = np.sqrt(max(column['sumsq'] / present - mean**2, 0)) if mean is not None else None
+        profile.append({
+            'Column': name,
+            'Type': 'numeric' if name in numeric else 'text',
+            'Count': int(round(column['count'] / sampled)) if sampled else 0,
+            'Nulls': int(round(column['nulls'] / sampled)) if sampled else 0,
+            'NullPct': 100 * column['nulls'] / max(column['count'], 1),
+            'Min': column['min'],
+            'Max': column['max'],
+            'Mean': mean,
+            'Std': std,
+            'Distinct': _sketch_estimate(column['sketch'], sketch_size),
+            'Histogram': column['histogram'].tolist() if name in numeric and column['edges'] is not None else None,
+            'HistogramRange': (column['edges'][0], column['edges'][-1])
+                              if name in numeric and column['edges'] is not None else None,
+            'SampledPct': 100 * sampled,
+        })
+    df = pd.DataFrame(profile).set_index('Column')
+    df.attrs.update({'rows': rows, 'bytes_read': read, 'converged': converged, 'sampled': sampled})
+    return df
+
+# Existence checks answer from delimiter listings of a shared prefix when enough keys share
+# it, and from HEAD requests otherwise. A listing starts at the group's smallest key, stops
+# past its largest and reads at most one page per min_keys keys, so keys in a large prefix
+# do not cost more LIST pages than HEADs; keys past where it stopped are checked with HEAD.
+# Both are cached for EXISTS_CACHE_TTL seconds.
+
+EXISTS_CACHE_TTL = 60
+_listing_cache = {}
+_head_cache = {}
+_exists_cache_lock = threading.Lock()
+
+def _key_parent(key):
+    return key[:key.rfind('/') + 1]
+
+def _list_keys_range(bucket, parent, low, high, max_pages):
+    # ({key: (size, etag)}, last) for the objects in parent from low on, stopping once past
+    # high or after max_pages pages. Keys from low to last are covered, last None to the end.
+    objects = {}
+    pages = aws_client('s3').get_paginator('list_objects_v2').paginate(
+        Bucket=bucket, Prefix=parent, Delimiter='/', StartAfter=low[:-1])
+    for count, page in enumerate(pages, 1):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = (obj['Size'], obj['ETag'].strip('"'))
+        last = max([obj['Key'] for obj in page.get('Contents', [])] +
+                   [prefix['Prefix'] for prefix in page.get('CommonPrefixes', [])], default=None)
+        if last is not None and (last >= high or count >= max_pages):
+            return objects, last
+    return objects, None
+
+def _listing_covers(listed, key):
+    _, _, low, last = listed
+    return low <= key and (last is None or key <= last)
+
+def _head_key(bucket, key):
     try:
-        s3_resource.Object(bucket, key).load()
+        response = aws_client('s3').head_object(Bucket=bucket, Key=key)
     except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == "404":
-            # The key does not exist.
-            return(False)
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None
+        raise
+    return response['ContentLength'], response['ETag'].strip('"')
+
+def keys_metadata(bucket, keys, min_keys=10, workers=16, ttl=EXISTS_CACHE_TTL):
+    # {key: (size, etag) or None when the key does not exist}
+    result = {}
+    pending = {}
+    now = time.time()
+    with _exists_cache_lock:
+        for key in keys:
+            parent = _key_parent(key)
+            listed = _listing_cache.get((bucket, parent))
+            head = _head_cache.get((bucket, key))
+            if listed and now - listed[0] <= ttl and _listing_covers(listed, key):
+                result[key] = listed[1].get(key)
+            elif head and now - head[0] <= ttl:
+                result[key] = head[1]
+            else:
+                pending.setdefault(parent, []).append(key)
+
+    listings = [parent for parent, group in pending.items() if len(group) >= min_keys]
+    heads = [key for parent, group in pending.items() if len(group) < min_keys for key in group]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        listed = executor.map(lambda parent: _list_keys_range(bucket, parent, min(pending[parent]),
+            max(pending[parent]), max(len(pending[parent]) // min_keys, 1)), listings)
+        listed = dict(zip(listings, listed))
+
+        now = time.time()
+        with _exists_cache_lock:
+            for parent, (objects, last) in listed.items():
+                entry = (now, objects, min(pending[parent]), last)
+                _listing_cache[(bucket, parent)] = entry
+                for key in pending[parent]:
+                    if _listing_covers(entry, key):
+                        result[key] = objects.get(key)
+                    else:
+                        heads.append(key)
+
+        headed = dict(zip(heads, executor.map(lambda key: _head_key(bucket, key), heads)))
+
+    now = time.time()
+    with _exists_cache_lock:
+        for key, meta in headed.items():
+            _head_cache[(bucket, key)] = (now, meta)
+            result[key] = meta
+    return result
+
+def keys_exist(bucket, keys, min_keys=10, workers=16, ttl=EXISTS_CACHE_TTL):
+    keys = list(keys)
+    metadata = keys_metadata(bucket, keys, min_keys, workers, ttl)
+    return pd.DataFrame({
+        'Key': keys,
+        'Exists': [metadata[key] is not None for key in keys],
+        'Size': pd.array([metadata[key][0] if metadata[key] else None for key in keys], dtype='Int64'),
+        'ETag': [metadata[key][1] if metadata[key] else None for key in keys],
+    })
+
+def exists_cache_invalidate(bucket, key=None):
+    with _exists_cache_lock:
+        if key is None:
+            for cache in (_listing_cache, _head_cache):
+                for cached in [cached for cached in cache if cached[0] == bucket]:
+                    del cache[cached]
         else:
-            # Something else has gone wrong.
-            raise
-    else:
-        # The key does exist.
-        return(True)
+            _head_cache.pop((bucket, key), None)
+            _listing_cache.pop((bucket, _key_parent(key)), None)
+
+def key_exists(bucket, key):
+    return keys_metadata(bucket, [key])[key] is not None
 
 def copy_among_buckets(from_bucket, from_key, to_bucket, to_key):
     if not key_exists(to_bucket, to_key):
-        s3_resource.meta.client.copy({'Bucket': from_bucket, 'Key': from_key}, 
+        aws_client('s3').copy({'Bucket': from_bucket, 'Key': from_key}, 
                                         to_bucket, to_key)        
+        exists_cache_invalidate(to_bucket, to_key)
         print(f'File {to_key} saved to S3 bucket {to_bucket}')
     else:
         print(f'File {to_key} already exists in S3 bucket {to_bucket}') 
 
-def s3_select(bucket, key, statement):
-    import io
+def list_objects_metadata(bucket, prefix=''):
+    # {key: (size, etag)} for every object under prefix
+    return {obj['Key']: (obj['Size'], obj['ETag'].strip('"'))
+            for page in iter_bucket_pages(bucket, prefix=prefix) for obj in page}
+
+def same_object(source, destination):
+    # Multipart ETags depend on the part size, so compare sizes only when either side is multipart
+    if destination is None or source[0] != destination[0]:
+        return False
+    return source[1] == destination[1] or '-' in source[1] or '-' in destination[1]
 
-    s3_select_results = s3.select_object_content(
+def copy_bucket_objects(from_bucket, to_bucket, prefix='', to_prefix=None, manifest=None,
+                        workers=16, chunk_mb=64, part_workers=4):
+    # Mirror objects with server side copies. Copies every key under prefix, or the keys in
+    # manifest (source keys or (source, destination) pairs). Destination keys replace prefix
+    # with to_prefix. Objects already in the destination with the same size and ETag are skipped.
+    if manifest is None:
+        source = list_objects_metadata(from_bucket, prefix)
+        pairs = [(key, key) for key in source]
+    else:
+        pairs = [(item, item) if isinstance(item, str) else tuple(item) for item in manifest]
+        source = keys_metadata(from_bucket, [key for key, _ in pairs], workers=workers)
+    if to_prefix is not None:
+        pairs = [(key, to_prefix + to_key[len(prefix):]) for key, to_key in pairs]
+    if not pairs:
+        print('Nothing to copy')
+        return pd.DataFrame(columns=['Key', 'ToKey', 'Size', 'Status', 'Error'])
+
+    if manifest is None:
+        # Destination keys share a prefix, a single listing covers them
+        destination = list_objects_metadata(to_bucket, os.path.commonprefix([to_key for _, to_key in pairs]))
+    else:
+        destination = keys_metadata(to_bucket, [to_key for _, to_key in pairs], workers=workers)
+    config = TransferConfig(multipart_threshold=chunk_mb*1024*1024, multipart_chunksize=chunk_mb*1024*1024,
+                            max_concurrency=part_workers)
+
+    # Every copy thread runs up to part_workers part copies on the same client
+    client = aws_client('s3', pool=workers*part_workers)
+
+    def copy(pair):
+        key, to_key = pair
+        if not source.get(key):
+            return 'missing', None
+        if same_object(source[key], destination.get(to_key)):
+            return 'skipped', None
+        try:
+            client.copy({'Bucket': from_bucket, 'Key': key}, to_bucket, to_key, Config=config)
+        except botocore.exceptions.ClientError as e:
+            logging.error(e)
+            return 'failed', e.response['Error']['Code']
+        exists_cache_invalidate(to_bucket, to_key)
+        return 'copied', None
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(copy, pairs))
+    elapsed = time.time() - start
+
+    df = pd.DataFrame({'Key': [key for key, _ in pairs], 'ToKey': [to_key for _, to_key in pairs],
+                       'Size': [(source.get(key) or (0, ''))[0] for key, _ in pairs],
+                       'Status': [status for status, _ in results], 'Error': [error for _, error in results]})
+    copied = df[df['Status'] == 'copied']
+    print(f"Copied {len(copied)} files ({copied['Size'].sum()/1024/1024:,.0f}MB) in {elapsed:.1f}s "
+          f"({copied['Size'].sum()/1024/1024/max(elapsed, 1e-3):,.1f}MB/s), "
+          f"skipped {(df['Status'] == 'skipped').sum()}, missing {(df['Status'] == 'missing').sum()}, "
+          f"failed {(df['Status'] == 'failed').sum()}")
+    return df
+
+def _print_select_stats(details, end='\n'):
+    print(f"Scanned: {int(details['BytesScanned'])/1024/1024:5.2f}MB  "
+          f"Processed: {int(details['BytesProcessed'])/1024/1024:5.2f}MB  "
+          f"Returned: {int(details['BytesReturned'])/1024/1024:5.2f}MB", end=end)
+
+SELECT_INPUT_FORMATS = {
+    'csv': {'CSV': {'FileHeaderInfo': 'Use'}},
+    'csv.gz': {'CSV': {'FileHeaderInfo': 'Use'}, 'CompressionType': 'GZIP'},
+    'csv.bz2': {'CSV': {'FileHeaderInfo': 'Use'}, 'CompressionType': 'BZIP2'},
+    'parquet': {'Parquet': {}},
+}
+
+def select_input_format(key):
+    for suffix in ['.csv.gz', '.csv.bz2', '.parquet']:
+        if key.lower().endswith(suffix):
+            return suffix[1:]
+    return 'csv'
+
+def select_column_names(statement):
+    # Column names S3 Select gives the projection: the alias, the column
+    # name without the table alias, or _N for expressions. None for SELECT * and SELECT s.*.
+    projection = re.match(r'\s*select\s+(.*?)\s+from\s', statement, re.IGNORECASE | re.DOTALL)
+    if not projection or re.fullmatch(r'(?:\w+\.)?\*', projection.group(1).strip()):
+        return None
+    items = re.split(r',(?![^(]*\))', projection.group(1))
+    columns = []
+    for i, item in enumerate(items, 1):
+        item = item.strip()
+        alias = re.search(r'\s+as\s+"?(\w+)"?$', item, re.IGNORECASE)
+        name = re.fullmatch(r'(?:\w+\.)?"?(\w+)"?', item)
+        if alias:
+            columns.append(alias.group(1))
+        elif name:
+            columns.append(name.group(1))
+        else:
+            columns.append(f'_{i}')
+    return columns
+
+def csv_header(bucket, key, input_format='csv'):
+    body = aws_client('s3').get_object(Bucket=bucket, Key=key, Range='bytes=0-65535')['Body'].read()
+    if input_format == 'csv.gz':
+        body = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(body)
+    elif input_format == 'csv.bz2':
+        body = bz2.BZ2Decompressor().decompress(body)
+    if b'\n' not in body:
+        return None
+    line = body.split(b'\n', 1)[0].rstrip(b'\r').decode('utf-8')
+    return next(csv.reader([line]))
+
+def _parse_select(data, output='json', columns=None):
+    if output == 'json':
+        return pd.read_json(io.BytesIO(data), lines=True)
+    if output == 'arrow':
+        import pyarrow
+        import pyarrow.csv
+        if not data.strip():
+            return pyarrow.Table.from_pandas(pd.DataFrame(columns=columns or []), preserve_index=False)
+        table = pyarrow.csv.read_csv(io.BytesIO(data),
+            read_options=pyarrow.csv.ReadOptions(autogenerate_column_names=True))
+        if not columns or len(columns) != table.num_columns:
+            columns = [f'_{i}' for i in range(1, table.num_columns + 1)]
+        return table.rename_columns(columns)
+    if not data.strip():
+        return pd.DataFrame(columns=columns or [])
+    df = pd.read_csv(io.BytesIO(data), header=None)
+    if not columns or len(columns) != len(df.columns):
+        columns = [f'_{i}' for i in range(1, len(df.columns) + 1)]
+    df.columns = columns
+    return df
+
+def _select_result(data, selected, output, columns=None):
+    # JSON selected for lack of column names is returned as the output asked for
+    result = _parse_select(data, selected, columns)
+    if selected != output and output == 'arrow':
+        import pyarrow
+        return pyarrow.Table.from_pandas(result, preserve_index=False)
+    return result
+
+def _select_columns(bucket, key, statement, input_format, output):
+    # Column names for CSV and arrow output, and the output to select. Without names
+    # (SELECT * on Parquet or JSON input) JSON is selected, as it keeps them.
+    if output == 'json':
+        return None, output
+    columns = select_column_names(statement)
+    if columns is None and input_format.startswith('csv'):
+        columns = csv_header(bucket, key, input_format)
+    return columns, output if columns is not None else 'json'
+
+def s3_select_payload(bucket, key, statement, input_format=None, output='json', scan_range=None, stats=None):
+    # When a stats dict is passed the final Stats are stored in it instead of printed
+    params = {}
+    if scan_range:
+        params['ScanRange'] = {'Start': scan_range[0], 'End': scan_range[1]}
+    s3_select_results = aws_client('s3').select_object_content(
         Bucket=bucket,
         Key=key,
         Expression=statement,
         ExpressionType='SQL',
-        InputSerialization={'CSV': {"FileHeaderInfo": "Use"}},
-        OutputSerialization={'JSON': {}},
+        InputSerialization=SELECT_INPUT_FORMATS[input_format or select_input_format(key)],
+        OutputSerialization={'JSON': {}} if output == 'json' else {'CSV': {}},
+        RequestProgress={'Enabled': stats is None},
+        **params,
     )
 
     for event in s3_select_results['Payload']:
         if 'Records' in event:
-            df = pd.read_json(io.StringIO(event['Records']['Payload'].decode('utf-8')), lines=True)
+            yield event['Records']['Payload']
+        elif 'Progress' in event:
+            _print_select_stats(event['Progress']['Details'], end='\r')
         elif 'Stats' in event:
-            print(f"Scanned: {int(event['Stats']['Details']['BytesScanned'])/1024/1024:5.2f}MB")            
-            print(f"Processed: {int(event['Stats']['Details']['BytesProcessed'])/1024/1024:5.2f}MB")
-            print(f"Returned: {int(event['Stats']['Details']['BytesReturned'])/1024/1024:5.2f}MB")
-    return (df)
+            if stats is None:
+                _print_select_stats(event['Stats']['Details'])
+            else:
+                stats.update(event['Stats']['Details'])
+
+def s3_select_chunks(bucket, key, statement, input_format=None, output='json'):
+    input_format = input_format or select_input_format(key)
+    columns, selected = _select_columns(bucket, key, statement, input_format, output)
+    # Records events are not aligned to rows, so carry the partial last line over
+    tail = b''
+    for payload in s3_select_payload(bucket, key, statement, input_format, selected):
+        data = tail + payload
+        end = data.rfind(b'\n') + 1
+        tail = data[end:]
+        if end:
+            yield _select_result(data[:end], selected, output, columns)
+    if tail.strip():
+        yield _select_result(tail, selected, output, columns)
+
+def s3_select(bucket, key, statement, input_format=None, output='json'):
+    # output is 'json', 'csv' (typed columns via the CSV reader) or 'arrow' (pyarrow Table)
+    input_format = input_format or select_input_format(key)
+    columns, selected = _select_columns(bucket, key, statement, input_format, output)
+    buffer = io.BytesIO()
+    for payload in s3_select_payload(bucket, key, statement, input_format, selected):
+        buffer.write(payload)
+    return _select_result(buffer.getvalue(), selected, output, columns)
+
+
+SELECT_REDUCERS = {'count': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max'}
+
+def select_aggregates(statement):
+    # Aggregate function of every projected column, or None unless all columns are aggregates
+    projection = re.match(r'\s*select\s+(.*?)\s+from\s', statement, re.IGNORECASE | re.DOTALL)
+    if not projection:
+        return None
+    functions = [re.match(r'\s*(\w+)\s*\(', item)
+        for item in re.split(r',(?![^(]*\))', projection.group(1))]
+    functions = [f.group(1).lower() if f else None for f in functions]
+    if not all(f in SELECT_REDUCERS or f == 'avg' for f in functions):
+        return None
+    return functions
+
+def s3_select_parallel(bucket, key, statement, workers=16, parts=None, part_mb=64, output='json'):
+    # Scatter the query over byte ranges of an uncompressed CSV object with ScanRange,
+    # gather the results in range order and reduce aggregate queries. output is 'json' or 'csv'.
+    size = aws_client('s3').head_object(Bucket=bucket, Key=key)['ContentLength']
+    parts = parts or max(1, min(workers*4, -(-size // (part_mb*1024*1024))))
+    bounds = np.linspace(0, size, parts + 1).astype('int64')
+    aggregates = select_aggregates(statement)
+    if aggregates and 'avg' in aggregates:
+        raise ValueError('AVG cannot be reduced across scan ranges, select SUM and COUNT instead')
+    columns, selected = _select_columns(bucket, key, statement, 'csv', output)
+
+    def select_range(start, end):
+        stats = {}
+        data = b''.join(s3_select_payload(bucket, key, statement, 'csv', selected,
+                                          scan_range=(int(start), int(end) - 1), stats=stats))
+        return data, stats
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(select_range, bounds[:-1], bounds[1:]))
+
+    totals = {}
+    for _, stats in results:
+        for name, value in stats.items():
+            totals[name] = totals.get(name, 0) + int(value)
+    if totals:
+        _print_select_stats(totals)
+
+    df = _select_result(b''.join(data for data, _ in results), selected, output, columns)
+    if aggregates:
+        df = df.agg({column: SELECT_REDUCERS[f] for column, f in zip(df.columns, aggregates)}).to_frame().T.infer_objects()
+    limit = re.search(r'\blimit\s+(\d+)\s*;?\s*$', statement, re.IGNORECASE)
+    if limit:
+        df = df.head(int(limit.group(1)))
+    return df
 
 
 # Function library from https://github.com/aws-samples/aws-open-data-analytics-notebooks/tree/master/optimizing-data
 
-def list_glue_databases():
-    glue_database = glue.get_databases()
+# Glue catalog browser. Databases and tables are paged through completely, databases are
+# fetched concurrently and each database's table list is cached in memory and as JSON on
+# disk for glue_cache_config['ttl'] seconds.
+
+GLUE_CACHE_DIR = os.environ.get('CLOUDSTORY_GLUE_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cloudstory', 'glue-catalog'))
+glue_cache_config = {'ttl': 3600}
+_glue_cache = {}
+_glue_cache_lock = threading.Lock()
+
+def _glue_cache_path(name):
+    region = _client_kwargs('glue').get('region_name', 'default')
+    return os.path.join(GLUE_CACHE_DIR, region, name + '.json')
+
+def _glue_cached(name, fetch, refresh=False):
+    now = time.time()
+    path = _glue_cache_path(name)
+    if not refresh:
+        with _glue_cache_lock:
+            entry = _glue_cache.get(path)
+        if entry and now - entry[0] <= glue_cache_config['ttl']:
+            return entry[1]
+        if os.path.exists(path) and now - os.path.getmtime(path) <= glue_cache_config['ttl']:
+            with open(path) as f:
+                items = json.load(f)
+            with _glue_cache_lock:
+                _glue_cache[path] = (os.path.getmtime(path), items)
+            return items
+    # Round trip through JSON so fresh and cached entries look the same (timestamps as strings)
+    items = json.loads(json.dumps(fetch(), default=str))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(items, f)
+    with _glue_cache_lock:
+        _glue_cache[path] = (now, items)
+    return items
+
+def glue_cache_invalidate(database=None):
+    # Drop one database's tables, or everything cached for the current region
+    with _glue_cache_lock:
+        directory = os.path.dirname(_glue_cache_path(''))
+        if database:
+            paths = [_glue_cache_path('tables-' + database)]
+        else:
+            paths = [p for p in _glue_cache if os.path.dirname(p) == directory]
+            if os.path.isdir(directory):
+                paths += [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.json')]
+        for path in paths:
+            _glue_cache.pop(path, None)
+            if os.path.exists(path):
+                os.remove(path)
+
+def glue_databases(refresh=False):
+    def fetch():
+        paginator = aws_client('glue').get_paginator('get_databases')
+        return [db for page in paginator.paginate() for db in page['DatabaseList']]
+    return _glue_cached('databases', fetch, refresh)
+
+def glue_tables(database, refresh=False):
+    def fetch():
+        paginator = aws_client('glue').get_paginator('get_tables')
+        return [table for page in paginator.paginate(DatabaseName=database) for table in page['TableList']]
+    return _glue_cached('tables-' + database, fetch, refresh)
+
+def _glue_table_rows(database, table):
+    params = table.get('Parameters', {})
+    storage = table.get('StorageDescriptor', {})
+    info = {
+        'Database': database,
+        'Table': table['Name'],
+        'Location': storage.get('Location'),
+        'CreatedBy': table.get('CreatedBy', '').split('/')[-1],
+        'UpdateTime': table.get('UpdateTime'),
+        'Classification': params.get('classification'),
+        'InputFormat': storage.get('InputFormat'),
+        'Compression': params.get('compressionType'),
+        'Records': float(params['recordCount']) if 'recordCount' in params else np.nan,
+        'AverageRecordSize': float(params['averageRecordSize']) if 'averageRecordSize' in params else np.nan,
+        'SizeMB': float(params['sizeKey'])/1024/1024 if 'sizeKey' in params else np.nan,
+        'Objects': float(params['objectCount']) if 'objectCount' in params else np.nan,
+        'Crawler': params.get('UPDATED_BY_CRAWLER'),
+    }
+    columns = [(c, False) for c in storage.get('Columns', [])]
+    columns += [(c, True) for c in table.get('PartitionKeys', [])]
+    if not columns:
+        return [dict(info, Column=None, Type=None, Partition=False, Position=np.nan)]
+    return [dict(info, Column=c['Name'], Type=c.get('Type'), Partition=partition, Position=i)
+            for i, (c, partition) in enumerate(columns)]
+
+def glue_catalog(databases=None, workers=8, refresh=False):
+    # One row per table column (partition keys flagged) with the table's crawler statistics
+    if databases is None:
+        databases = [db['Name'] for db in glue_databases(refresh)]
+    elif isinstance(databases, str):
+        databases = [databases]
 
-    for db in glue_database['DatabaseList']:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tables = list(executor.map(lambda database: glue_tables(database, refresh), databases))
+
+    rows = [row for database, items in zip(databases, tables)
+            for table in items for row in _glue_table_rows(database, table)]
+    columns = ['Database', 'Table', 'Column', 'Type', 'Partition', 'Position', 'Location', 'CreatedBy',
+               'UpdateTime', 'Classification', 'InputFormat', 'Compression', 'Records',
+               'AverageRecordSize', 'SizeMB', 'Objects', 'Crawler']
+    return pd.DataFrame(rows, columns=columns)
+
+def list_glue_databases(refresh=False):
+    for db in glue_databases(refresh):
         print(db['Name'])
 
-def list_glue_tables(database, verbose=True):
-    glue_tables = glue.get_tables(DatabaseName=database)
+def list_glue_tables(database, verbose=True, refresh=False):
+    from IPython.display import display, Markdown
+    catalog = glue_catalog(database, refresh=refresh)
     
-    for table in glue_tables['TableList']:
-        display(Markdown('**Table: ' + table['Name'] + '**'))
-        display(Markdown('Location: ' + table['StorageDescriptor']['Location']))
-        created = table['CreatedBy'].split('/')
-        display(Markdown('Created by: ' + created[-1]))
-        if verbose and created[-1] == 'AWS Crawler':
-            display(Markdown(f'Records: {int(table["Parameters"]["recordCount"]):,}'))
-            display(Markdown(f'Average Record Size: {table["Parameters"]["averageRecordSize"]} Bytes'))
-            display(Markdown(f'Dataset Size: {float(table["Parameters"]["sizeKey"])/1024/1024:3.0f} MB'))
-            display(Markdown(f'Crawler: {table["Parameters"]["UPDATED_BY_CRAWLER"]}'))
+    for table, df in catalog.groupby('Table', sort=False):
+        first = df.iloc[0]
+        lines = [f'**Table: {table}**', f'Location: {first["Location"]}', f'Created by: {first["CreatedBy"]}']
+        if verbose and first['Crawler']:
+            lines += [f'Records: {int(first["Records"]):,}',
+                      f'Average Record Size: {first["AverageRecordSize"]:g} Bytes',
+                      f'Dataset Size: {first["SizeMB"]:3.0f} MB',
+                      f'Crawler: {first["Crawler"]}']
+        display(Markdown('  \n'.join(lines)))
         if verbose:
-            df_columns = pd.DataFrame.from_dict(table["StorageDescriptor"]["Columns"])
-            display(df_columns[['Name', 'Type']])
+            display(df[['Column', 'Type', 'Partition']].reset_index(drop=True))
             display(Markdown('---'))
 
-def athena_query(query, bucket, folder):
+# Optimization advisor for Glue tables. Uses crawler statistics (sizeKey, recordCount,
+# averageRecordSize, objectCount) and column types to estimate what a typical Athena query
+# scans today and after conversion to Parquet, partitioning and compaction, ranked by the
+# monthly saving at Athena's per TB scanned price (10MB minimum per query).
+
+ATHENA_PRICE_PER_TB = 5.0
+ATHENA_MIN_SCAN_MB = 10
+PARQUET_SIZE_RATIO = 0.25
+COMPACTION_TARGET_MB = 128
+ATHENA_MAX_PARTITIONS = 100
+PARTITION_NAMES = re.compile(r'(^|_)(year|month|day|dt|region|country|state)$', re.IGNORECASE)
+PARTITION_TIMES = re.compile(r'(date|datetime|time|timestamp)$', re.IGNORECASE)
+
+def athena_scan_cost(scan_mb, queries=1):
+    # Athena rounds each query up to the next MB, with a 10MB minimum
+    scan_mb = max(np.ceil(scan_mb), ATHENA_MIN_SCAN_MB)
+    return queries * scan_mb / 1024 / 1024 * ATHENA_PRICE_PER_TB
+
+def partition_candidates(columns):
+    # (column, expression) pairs, low cardinality names first, then times bucketed by month
+    names, times = [], []
+    for name, kind in columns:
+        kind = (kind or '').lower()
+        if PARTITION_NAMES.search(name):
+            names.append((name, f'"{name}"'))
+        elif kind in ('date', 'timestamp'):
+            times.append((name + '_month', f"date_format(\"{name}\", '%Y-%m')"))
+        elif kind == 'string' and PARTITION_TIMES.search(name):
+            times.append((name + '_month', f'substr("{name}", 1, 7)'))
+    return names + times
+
+def _is_columnar(table):
+    text = f"{table['Classification'] or ''} {table['InputFormat'] or ''}".lower()
+    return 'parquet' in text or 'orc' in text
+
+def ctas_location(source, table, location=None, format='PARQUET'):
+    # CTAS output has to sit outside the source location, or queries on the source table
+    # would read the new files too. Defaults to a sibling of the source prefix.
+    source = (source or '').rstrip('/')
+    if location:
+        output = f"{location.rstrip('/')}/{table}_{format.lower()}/"
+    else:
+        bucket, prefix = _s3_location(source)
+        if not bucket or not prefix:
+            return None
+        parent = prefix.rpartition('/')[0]
+        output = f"s3://{bucket}/{parent + '/' if parent else ''}{table}_{format.lower()}/"
+    if source and output.startswith(source + '/'):
+        return None
+    return output
+
+def glue_partition_values(database, table):
+    # Value tuples of every partition of a table, in partition key order
+    values = []
+    for page in aws_client('glue').get_paginator('get_partitions').paginate(DatabaseName=database, TableName=table):
+        values += [tuple(partition['Values']) for partition in page['Partitions']]
+    return values
+
+def athena_partition_values(database, table, partitions, bucket, folder):
+    # Distinct values of partition expressions, from a query scanning their columns
+    select = ', '.join(expression for _, expression in partitions)
+    df = athena_query(f'SELECT DISTINCT {select} FROM "{database}"."{table}"', bucket, folder)
+    return [tuple(row) for row in df.itertuples(index=False)]
+
+def athena_ctas(database, table, columns, location, partitions=None, format='PARQUET', values=None):
+    # partitions are (name, expression) pairs, which have to come last in a CTAS select list.
+    # values are the partition value tuples the output will have. Athena writes at most
+    # ATHENA_MAX_PARTITIONS partitions per query, so past that the CTAS is followed by
+    # INSERT INTO statements, separated by ';', each writing a range of partition keys.
+    partitions = partitions or []
+    names = [name for name, _ in partitions]
+    select = [f'"{name}"' for name, _ in columns if name not in names]
+    select += [expression if expression == f'"{name}"' else f'{expression} AS "{name}"'
+               for name, expression in partitions]
+    options = [f"format = '{format}'", f"external_location = '{location}'"]
+    if format == 'PARQUET':
+        options.insert(1, "parquet_compression = 'SNAPPY'")
+    if partitions:
+        options.append('partitioned_by = ARRAY[' + ', '.join(f"'{name}'" for name in names) + ']')
+    target = f'{table}_{format.lower()}'
+    create = f'CREATE TABLE "{database}"."{target}"\nWITH ({", ".join(options)})\n'
+    query = f'SELECT {", ".join(select)}\nFROM "{database}"."{table}"'
+
+    keys = sorted({'|'.join(str(value) for value in row) for row in values or []})
+    if not partitions or len(keys) <= ATHENA_MAX_PARTITIONS:
+        return create + 'AS ' + query
+    # The ranges cover every key, so rows are written once even when a value was missed
+    key = 'concat_ws(\'|\', ' + ', '.join(f'CAST({expression} AS varchar)' for _, expression in partitions) + ')'
+    bounds = [bound.replace("'", "''") for bound in keys[ATHENA_MAX_PARTITIONS::ATHENA_MAX_PARTITIONS]]
+    statements = []
+    for i in range(len(bounds) + 1):
+        where = ([f"{key} >= '{bounds[i - 1]}'"] if i else []) + ([f"{key} < '{bounds[i]}'"] if i < len(bounds) else [])
+        batch = f'{query}\nWHERE {" AND ".join(where)}'
+        statements.append(create + 'AS ' + batch if i == 0 else f'INSERT INTO "{database}"."{target}"\n{batch}')
+    return ';\n\n'.join(statements)
+
+def glue_table_advice(catalog=None, databases=None, queries_per_day=10, columns_read=3,
+                      selectivity=0.1, location=None, format='PARQUET', athena_output=None):
+    # columns_read is what a typical query selects, selectivity the share of partitions it
+    # filters to. location is the s3://bucket/prefix CTAS output goes under, by default a
+    # sibling of each table's location. Existing partition keys are kept in the output, and
+    # statements are batched by their Glue partition values. athena_output, a (bucket,
+    # folder) pair, runs a DISTINCT query per new partition column to batch those too.
+    if catalog is None:
+        catalog = glue_catalog(databases)
+    queries = queries_per_day * 30
+    advice = []
+
+    for (database, table), df in catalog.groupby(['Database', 'Table'], sort=False):
+        info = df.iloc[0]
+        size_mb = info['SizeMB']
+        if np.isnan(size_mb):
+            size_mb = info['Records'] * info['AverageRecordSize'] / 1024 / 1024
+        data = df[~df['Partition'] & df['Column'].notna()]
+        columns = list(zip(data['Column'], data['Type']))
+        keys = [(name, f'"{name}"') for name in df.loc[df['Partition'] & df['Column'].notna(), 'Column']]
+        columnar = _is_columnar(info)
+        fraction = min(columns_read, len(columns)) / max(len(columns), 1)
+
+        scan = size_mb * (fraction if columnar else 1) * (selectivity if keys else 1)
+        # Partitions smaller than a compacted file only add per file overhead
+        large = size_mb * (1 if columnar else PARQUET_SIZE_RATIO) > COMPACTION_TARGET_MB
+        candidates = partition_candidates(columns) if large and not keys else []
+        partitions = keys or candidates[:1]
+        output = ctas_location(info['Location'], table, location, format)
+
+        def recommend(kind, optimized, detail, statement=None):
+            advice.append({
+                'Database': database,
+                'Table': table,
+                'Recommendation': kind,
+                'Detail': detail,
+                'SizeMB': size_mb,
+                'ScanMB': scan,
+                'OptimizedScanMB': optimized,
+                'CostPerQuery': athena_scan_cost(scan),
+                'OptimizedCostPerQuery': athena_scan_cost(optimized),
+                'MonthlySavings': athena_scan_cost(scan, queries) - athena_scan_cost(optimized, queries),
+                'Statement': statement,
+            })
+
+        if np.isnan(size_mb):
+            recommend('Run crawler', np.nan, 'No size statistics, run a Glue crawler to collect them')
+            continue
+
+        ctas, values = None, None
+        if output and (not columnar or candidates):
+            if keys:
+                values = glue_partition_values(database, table)
+            elif partitions and athena_output:
+                values = athena_partition_values(database, table, partitions, *athena_output)
+            ctas = athena_ctas(database, table, columns, output, partitions, format, values)
+        unchecked = bool(partitions) and values is None and bool(output)
+        limit = f', check it has at most {ATHENA_MAX_PARTITIONS} values or pass athena_output to batch the writes'
+
+        if not columnar:
+            optimized = size_mb * PARQUET_SIZE_RATIO * fraction * (selectivity if partitions else 1)
+            detail = f'Convert to {format.title()}, about {size_mb * PARQUET_SIZE_RATIO:,.0f}MB'
+            if partitions:
+                detail += ', partitioned by ' + ', '.join(name for name, _ in partitions)
+            if unchecked:
+                detail += limit
+            if not output:
+                detail += ', pass location for the output outside the table location'
+            recommend(f'Convert to {format.title()}', optimized, detail, ctas)
+        elif candidates:
+            detail = f'Partition by {candidates[0][0]}'
+            if unchecked:
+                detail += limit
+            if not output:
+                detail += ', pass location for the output outside the table location'
+            recommend('Partition', scan * selectivity, detail, ctas)
+
+        objects = info['Objects']
+        if not np.isnan(objects) and objects > 1 and size_mb / objects < COMPACTION_TARGET_MB / 2:
+            files = max(int(np.ceil(size_mb * (1 if columnar else PARQUET_SIZE_RATIO) / COMPACTION_TARGET_MB)), 1)
+            recommend('Compact files', scan,
+                      f'{int(objects):,} objects averaging {size_mb / objects:,.1f}MB, '
+                      f'rewrite into about {files:,} files of {COMPACTION_TARGET_MB}MB')
+
+    columns = ['Database', 'Table', 'Recommendation', 'Detail', 'SizeMB', 'ScanMB', 'OptimizedScanMB',
+               'CostPerQuery', 'OptimizedCostPerQuery', 'MonthlySavings', 'Statement']
+    df = pd.DataFrame(advice, columns=columns)
+    return df.sort_values('MonthlySavings', ascending=False, na_position='last', kind='stable').reset_index(drop=True)
+
+def _athena_state_error(execution):
+    status = execution['Status']
+    return RuntimeError(f"Athena query {execution['QueryExecutionId']} {status['State']}: "
+                        f"{status.get('StateChangeReason', '')}")
+
+def _print_athena_stats(execution):
+    stats = execution.get('Statistics', {})
+    print(f"Query {execution['QueryExecutionId']}: "
+          f"scanned {int(stats.get('DataScannedInBytes', 0))/1024/1024:5.2f}MB, "
+          f"engine {stats.get('EngineExecutionTimeInMillis', 0)} ms, "
+          f"queued {stats.get('QueryQueueTimeInMillis', 0)} ms")
+
+def athena_query(query, bucket, folder, delay=0.2, max_delay=5):
     output = 's3://' + bucket + '/' + folder + '/'
-    response = athena.start_query_execution(QueryString=query, 
+    response = aws_client('athena').start_query_execution(QueryString=query, 
                                         ResultConfiguration={'OutputLocation': output})
     qid = response['QueryExecutionId']
-    response = athena.get_query_execution(QueryExecutionId=qid)
+    response = aws_client('athena').get_query_execution(QueryExecutionId=qid)
     state = response['QueryExecution']['Status']['State']
-    while state == 'RUNNING':
-        response = athena.get_query_execution(QueryExecutionId=qid)
+    while state in ('QUEUED', 'RUNNING'):
+        time.sleep(delay)
+        delay = min(delay*2, max_delay)
+        response = aws_client('athena').get_query_execution(QueryExecutionId=qid)
         state = response['QueryExecution']['Status']['State']
+    if state != 'SUCCEEDED':
+        raise _athena_state_error(response['QueryExecution'])
+    _print_athena_stats(response['QueryExecution'])
     key = folder + '/' + qid + '.csv'
     data_source = {'Bucket': bucket, 'Key': key}
-    url = s3.generate_presigned_url(ClientMethod = 'get_object', Params = data_source)
+    url = aws_client('s3').generate_presigned_url(ClientMethod = 'get_object', Params = data_source)
     data = pd.read_csv(url)
     return data
 
+# Asyncio query runner. Client calls run on the default executor so the event loop
+# (and the notebook kernel) stays free; pass client to use a stubbed Athena.
+
+ATHENA_NUMERIC_TYPES = {'tinyint', 'smallint', 'integer', 'bigint', 'float', 'real', 'double', 'decimal'}
+
+async def _athena_call(client, method, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(getattr(client or aws_client('athena'), method), **kwargs))
+
+async def athena_wait(qid, client=None, delay=0.2, max_delay=10):
+    while True:
+        response = await _athena_call(client, 'get_query_execution', QueryExecutionId=qid)
+        execution = response['QueryExecution']
+        state = execution['Status']['State']
+        if state == 'SUCCEEDED':
+            return execution
+        if state in ('FAILED', 'CANCELLED'):
+            raise _athena_state_error(execution)
+        # Exponential backoff with jitter so many concurrent queries do not poll in lockstep
+        await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+        delay = min(delay*2, max_delay)
+
+def _athena_frame(rows, column_info):
+    names = [c['Name'] for c in column_info]
+    df = pd.DataFrame([[d.get('VarCharValue') for d in row['Data']] for row in rows], columns=names)
+    for column in column_info:
+        kind = column['Type'].lower()
+        if kind in ATHENA_NUMERIC_TYPES:
+            df[column['Name']] = pd.to_numeric(df[column['Name']])
+        elif kind == 'boolean':
+            df[column['Name']] = df[column['Name']].map({'true': True, 'false': False})
+        elif kind in ('date', 'timestamp'):
+            df[column['Name']] = pd.to_datetime(df[column['Name']], errors='coerce')
+    return df
+
+async def athena_results(qid, client=None, page_size=1000):
+    # Async generator of one typed DataFrame per get_query_results page
+    params = {'QueryExecutionId': qid, 'MaxResults': page_size}
+    first = True
+    while True:
+        response = await _athena_call(client, 'get_query_results', **params)
+        column_info = response['ResultSet']['ResultSetMetadata']['ColumnInfo']
+        rows = response['ResultSet']['Rows']
+        # SELECT results repeat the column labels as the first row
+        if first and rows and [d.get('VarCharValue') for d in rows[0]['Data']] == [c['Label'] for c in column_info]:
+            rows = rows[1:]
+        first = False
+        yield _athena_frame(rows, column_info)
+        if 'NextToken' not in response:
+            break
+        params['NextToken'] = response['NextToken']
+
+async def athena_query_async(query, bucket=None, folder=None, database=None, client=None):
+    params = {'QueryString': query}
+    if bucket:
+        params['ResultConfiguration'] = {'OutputLocation': f's3://{bucket}/{folder}/'}
+    if database:
+        params['QueryExecutionContext'] = {'Database': database}
+    response = await _athena_call(client, 'start_query_execution', **params)
+    execution = await athena_wait(response['QueryExecutionId'], client)
+    _print_athena_stats(execution)
+    frames = [df async for df in athena_results(execution['QueryExecutionId'], client)]
+    return pd.concat(frames, ignore_index=True)
+
+async def athena_queries(queries, bucket=None, folder=None, database=None, concurrency=5, client=None):
+    # Run many queries at once, at most concurrency in flight; results keep the order of queries
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(query):
+        async with semaphore:
+            return await athena_query_async(query, bucket, folder, database, client)
+
+    return await asyncio.gather(*(run(query) for query in queries))
+
+# Query result cache for athena_query and s3_select. Results are keyed by normalized SQL,
+# the queried object or tables and their version (ETag, or a digest of the tables' partitions
+# and S3 objects), kept in an in-memory LRU and written to Parquet files so they survive
+# kernel restarts.
+
+QUERY_CACHE_DIR = os.environ.get('CLOUDSTORY_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cloudstory', 'query-cache'))
+query_cache_config = {'ttl': 24*3600, 'memory_mb': 512, 'disk_mb': 4096}
+ATHENA_UNVERSIONED_TTL = 300
+query_cache_stats = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+_query_cache = OrderedDict()
+_query_cache_lock = threading.Lock()
+
+def normalize_sql(statement):
+    # Collapse whitespace and lowercase outside of quoted literals and identifiers
+    parts = re.split(r"""('(?:[^']|'')*'|"[^"]*")""", statement.strip().rstrip(';'))
+    return ''.join(part if i % 2 else re.sub(r'\s+', ' ', part).lower()
+                   for i, part in enumerate(parts)).strip()
+
+def query_cache_key(statement, target, version=''):
+    text = '\n'.join([normalize_sql(statement), target, str(version)])
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def _query_cache_path(key):
+    return os.path.join(QUERY_CACHE_DIR, key + '.parquet')
+
+def _query_cache_evict():
+    memory = sum(size for _, size, _ in _query_cache.values())
+    while _query_cache and memory > query_cache_config['memory_mb']*1024*1024:
+        _, (_, size, _) = _query_cache.popitem(last=False)
+        memory -= size
+    if not os.path.isdir(QUERY_CACHE_DIR):
+        return
+    files = [os.path.join(QUERY_CACHE_DIR, f) for f in os.listdir(QUERY_CACHE_DIR) if f.endswith('.parquet')]
+    files.sort(key=os.path.getmtime)
+    disk = sum(os.path.getsize(f) for f in files)
+    now = time.time()
+    for f in files:
+        if disk <= query_cache_config['disk_mb']*1024*1024 and now - os.path.getmtime(f) <= query_cache_config['ttl']:
+            continue
+        disk -= os.path.getsize(f)
+        os.remove(f)
+
+def _result_nbytes(result):
+    # Results are DataFrames, or pyarrow Tables from s3_select(output='arrow')
+    if isinstance(result, pd.DataFrame):
+        return int(result.memory_usage(deep=True).sum())
+    return int(result.nbytes)
+
+def _write_result(result, path):
+    if isinstance(result, pd.DataFrame):
+        result.to_parquet(path)
+    else:
+        import pyarrow.parquet as pq
+        pq.write_table(result, path)
+
+def _read_result(path):
+    # Files written from a DataFrame carry pandas metadata, Tables come back as Tables
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        return pd.read_parquet(path)
+    table = pq.read_table(path)
+    if table.schema.metadata and b'pandas' in table.schema.metadata:
+        return table.to_pandas()
+    return table
+
+def _result_copy(df):
+    # Callers get a copy, so changing a result does not change the cached one. Arrow
+    # Tables are immutable and returned as they are.
+    return df.copy() if isinstance(df, pd.DataFrame) else df
+
+def query_cache_get(key, ttl=None):
+    # ttl overrides query_cache_config['ttl'] for this lookup
+    ttl = ttl or query_cache_config['ttl']
+    now = time.time()
+    with _query_cache_lock:
+        if key in _query_cache:
+            created, _, df = _query_cache[key]
+            if now - created <= ttl:
+                _query_cache.move_to_end(key)
+                query_cache_stats['hits'] += 1
+                return _result_copy(df)
+            del _query_cache[key]
+    path = _query_cache_path(key)
+    if os.path.exists(path) and now - os.path.getmtime(path) <= ttl:
+        df = _read_result(path)
+        with _query_cache_lock:
+            _query_cache[key] = (os.path.getmtime(path), _result_nbytes(df), df)
+            query_cache_stats['disk_hits'] += 1
+        return _result_copy(df)
+    with _query_cache_lock:
+        query_cache_stats['misses'] += 1
+    return None
+
+def query_cache_put(key, df):
+    with _query_cache_lock:
+        _query_cache[key] = (time.time(), _result_nbytes(df), df)
+        _query_cache.move_to_end(key)
+    os.makedirs(QUERY_CACHE_DIR, exist_ok=True)
+    try:
+        _write_result(df, _query_cache_path(key))
+    except (ImportError, ValueError, TypeError) as e:
+        # No Parquet engine or columns Parquet cannot store, keep the result in memory only
+        logging.warning(f'Query result not written to disk cache: {e}')
+    with _query_cache_lock:
+        _query_cache_evict()
+    return _result_copy(df)
+
+def query_cache_invalidate(key=None):
+    # Drop one entry, or the whole cache when no key is given
+    with _query_cache_lock:
+        keys = [key] if key else list(_query_cache)
+        for k in keys:
+            _query_cache.pop(k, None)
+        if key:
+            paths = [_query_cache_path(key)]
+        elif os.path.isdir(QUERY_CACHE_DIR):
+            paths = [os.path.join(QUERY_CACHE_DIR, f) for f in os.listdir(QUERY_CACHE_DIR) if f.endswith('.parquet')]
+        else:
+            paths = []
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+def query_cache_info():
+    with _query_cache_lock:
+        return dict(query_cache_stats, entries=len(_query_cache),
+                    memory_mb=sum(size for _, size, _ in _query_cache.values())/1024/1024)
+
+def _s3_location(location):
+    bucket, _, prefix = re.sub(r'^s3[an]?://', '', location).partition('/')
+    return bucket, prefix
+
+def glue_table_version(database, table):
+    # Digest of the table definition, its partitions and the objects under its locations,
+    # so it changes when data lands in S3 and not only when the metadata is updated.
+    # Costs one LIST call per 1000 objects of the table.
+    glue = aws_client('glue')
+    definition = glue.get_table(DatabaseName=database, Name=table)['Table']
+    digest = hashlib.sha256(str(definition.get('UpdateTime', '')).encode('utf-8'))
+    locations = {definition.get('StorageDescriptor', {}).get('Location')}
+    if definition.get('PartitionKeys'):
+        for page in glue.get_paginator('get_partitions').paginate(DatabaseName=database, TableName=table):
+            for partition in page['Partitions']:
+                location = partition.get('StorageDescriptor', {}).get('Location')
+                digest.update(repr((partition['Values'], location)).encode('utf-8'))
+                locations.add(location)
+
+    # Partitions under the table location are covered by its listing
+    roots = []
+    for location in sorted(l.rstrip('/') + '/' for l in locations if l):
+        if not roots or not location.startswith(roots[-1]):
+            roots.append(location)
+    for location in roots:
+        bucket, prefix = _s3_location(location)
+        for page in aws_client('s3').get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for o in page.get('Contents', []):
+                digest.update(f"{o['Key']}|{o['ETag']}|{o['Size']}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def athena_query_tables(query):
+    # ("database", "table") references in a query, database '' when not qualified. FROM in
+    # function calls, as in EXTRACT(YEAR FROM ts), is skipped, FROM in subqueries is kept.
+    query = re.sub(r"'(?:[^']|'')*'", "''", query)
+    tables = set()
+    subquery = []
+    for match in re.finditer(r'\(\s*(\w*)|\)|\b(?:from|join)\s+(?:"?(\w+)"?\s*\.\s*)?"?(\w+)"?', query, re.IGNORECASE):
+        if match.group(0).startswith('('):
+            subquery.append(match.group(1).lower() in ('select', 'with'))
+        elif match.group(0) == ')':
+            subquery = subquery[:-1]
+        elif not subquery or subquery[-1]:
+            tables.add((match.group(2) or '', match.group(3)))
+    return sorted(tables)
+
+def cached_s3_select(bucket, key, statement, refresh=False, **kwargs):
+    etag = aws_client('s3').head_object(Bucket=bucket, Key=key)['ETag']
+    cache_key = query_cache_key(statement, f's3://{bucket}/{key}', etag + repr(sorted(kwargs.items())))
+    df = None if refresh else query_cache_get(cache_key)
+    if df is None:
+        df = query_cache_put(cache_key, s3_select(bucket, key, statement, **kwargs))
+    return df
+
+def cached_athena_query(query, bucket, folder, version=None, refresh=False, database='default'):
+    # version defaults to the glue_table_version of every table the query reads, unqualified
+    # names resolved in database. Names that are not catalog tables (CTEs) are left out, as
+    # they read catalog tables. Queries where no table could be versioned are cached for
+    # ATHENA_UNVERSIONED_TTL only.
+    ttl = None
+    if version is None:
+        version = []
+        for db, table in athena_query_tables(query):
+            try:
+                version.append((db or database, table, glue_table_version(db or database, table)))
+            except botocore.exceptions.ClientError:
+                continue
+        if not version:
+            ttl = ATHENA_UNVERSIONED_TTL
+    cache_key = query_cache_key(query, 'athena', version)
+    df = None if refresh else query_cache_get(cache_key, ttl)
+    if df is None:
+        df = query_cache_put(cache_key, athena_query(query, bucket, folder))
+    return df
+
 def heatmap(corr):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+
     sns.set(style="white")
 
     # Generate a mask for the upper triangle
@@ -188,20 +1408,21 @@ def heatmap(corr):
 # Function library from https://github.com/aws-samples/aws-open-data-analytics-notebooks/tree/master/ai-services
 
 def show_image(bucket, key, img_width = 500):
+    from IPython.display import Image
     # [TODO] Load non-public images
     return Image(url='https://s3.amazonaws.com/' + bucket + '/' + key, width=img_width)
 
 def image_labels(bucket, key):
     image_object = {'S3Object':{'Bucket': bucket,'Name': key}}
 
-    response = rekognition.detect_labels(Image=image_object)
+    response = aws_client('rekognition').detect_labels(Image=image_object)
     for label in response['Labels']:
         print('{} ({:.0f}%)'.format(label['Name'], label['Confidence']))
 
 def image_label_count(bucket, key, match):    
     image_object = {'S3Object':{'Bucket': bucket,'Name': key}}
 
-    response = rekognition.detect_labels(Image=image_object)
+    response = aws_client('rekognition').detect_labels(Image=image_object)
     count = 0
     for label in response['Labels']:
         if match in label['Name']:
@@ -210,7 +1431,7 @@ def image_label_count(bucket, key, match):
     print(f'Found {match} {count} times.')
 
 def image_text(bucket, key, sort_column='', parents=True):
-    response = rekognition.detect_text(Image={'S3Object':{'Bucket':bucket,'Name': key}})
+    response = aws_client('rekognition').detect_text(Image={'S3Object':{'Bucket':bucket,'Name': key}})
     df = pd.read_json(io.StringIO(json.dumps(response['TextDetections'])))
     df['Width'] = df['Geometry'].apply(lambda x: x['BoundingBox']['Width'])
     df['Height'] = df['Geometry'].apply(lambda x: x['BoundingBox']['Height'])
@@ -226,7 +1447,7 @@ def image_text(bucket, key, sort_column='', parents=True):
 def detect_celebs(bucket, key, sort_column=''):
     image_object = {'S3Object':{'Bucket': bucket,'Name': key}}
 
-    response = rekognition.recognize_celebrities(Image=image_object)
+    response = aws_client('rekognition').recognize_celebrities(Image=image_object)
     df = pd.DataFrame(response['CelebrityFaces'])
     df['Width'] = df['Face'].apply(lambda x: x['BoundingBox']['Width'])
     df['Height'] = df['Face'].apply(lambda x: x['BoundingBox']['Height'])
@@ -237,29 +1458,221 @@ def detect_celebs(bucket, key, sort_column=''):
         df = df.sort_values([sort_column])
     return(df)
 
+# Batch image analysis over a bucket prefix
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png')
+THROTTLING_ERRORS = {'ThrottlingException', 'ProvisionedThroughputExceededException',
+                     'LimitExceededException', 'TooManyRequestsException'}
+
+def rate_limiter(rate):
+    # Shared by worker threads, spaces calls so at most rate start per second
+    lock = threading.Lock()
+    next_call = [time.monotonic()]
+
+    def wait():
+        with lock:
+            now = time.monotonic()
+            start = max(now, next_call[0])
+            next_call[0] = start + 1/rate
+        time.sleep(max(0, start - now))
+
+    return wait
+
+def call_with_retry(fn, retries=6, delay=0.5, **kwargs):
+    for attempt in range(retries + 1):
+        try:
+            return fn(**kwargs)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in THROTTLING_ERRORS or attempt == retries:
+                raise
+            time.sleep(delay * 2**attempt * random.uniform(0.5, 1.5))
+
+def list_images(bucket, prefix=''):
+    keys = [obj['Key'] for page in iter_bucket_pages(bucket, prefix=prefix)
+            for obj in page if obj['Key'].lower().endswith(IMAGE_SUFFIXES)]
+    return sorted(keys)
+
+def _batch_rekognition(bucket, keys, method, workers, rate):
+    limit = rate_limiter(rate)
+    fn = getattr(aws_client('rekognition'), method)
+
+    def analyse(key):
+        limit()
+        try:
+            return key, call_with_retry(fn, Image={'S3Object': {'Bucket': bucket, 'Name': key}}), None
+        except botocore.exceptions.ClientError as e:
+            return key, None, e.response['Error']['Code']
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(analyse, keys))
+    errors = [(key, error) for key, _, error in results if error]
+    if errors:
+        print(f'{len(errors)} of {len(keys)} images failed, first: {errors[0][0]} ({errors[0][1]})')
+    return [(key, response) for key, response, error in results if not error]
+
+def batch_image_labels(bucket, prefix='', keys=None, workers=8, rate=5):
+    # One row per label per image
+    keys = keys if keys is not None else list_images(bucket, prefix)
+    columns = {'Key': [], 'Name': [], 'Confidence': [], 'Instances': [], 'Parents': []}
+    for key, response in _batch_rekognition(bucket, keys, 'detect_labels', workers, rate):
+        for label in response['Labels']:
+            columns['Key'].append(key)
+            columns['Name'].append(label['Name'])
+            columns['Confidence'].append(label['Confidence'])
+            columns['Instances'].append(len(label.get('Instances', [])))
+            columns['Parents'].append(', '.join(parent['Name'] for parent in label.get('Parents', [])))
+    df = pd.DataFrame(columns)
+    df['Key'] = df['Key'].astype('category')
+    df['Name'] = df['Name'].astype('category')
+    return df
+
+def batch_image_text(bucket, prefix='', keys=None, workers=8, rate=5):
+    # One row per detected line or word per image
+    keys = keys if keys is not None else list_images(bucket, prefix)
+    columns = {'Key': [], 'DetectedText': [], 'Type': [], 'Id': [], 'ParentId': [], 'Confidence': [],
+               'Width': [], 'Height': [], 'Left': [], 'Top': []}
+    for key, response in _batch_rekognition(bucket, keys, 'detect_text', workers, rate):
+        for text in response['TextDetections']:
+            box = text['Geometry']['BoundingBox']
+            columns['Key'].append(key)
+            columns['DetectedText'].append(text['DetectedText'])
+            columns['Type'].append(text['Type'])
+            columns['Id'].append(text['Id'])
+            columns['ParentId'].append(text.get('ParentId', -1))
+            columns['Confidence'].append(text['Confidence'])
+            columns['Width'].append(box['Width'])
+            columns['Height'].append(box['Height'])
+            columns['Left'].append(box['Left'])
+            columns['Top'].append(box['Top'])
+    df = pd.DataFrame(columns)
+    df['Key'] = df['Key'].astype('category')
+    df['Type'] = df['Type'].astype('category')
+    return df
+
 def comprehend_syntax(text): 
-    response = comprehend.detect_syntax(Text=text, LanguageCode='en')
-    df = pd.read_json(io.StringIO(json.dumps(response['SyntaxTokens'])))
+    response = aws_client('comprehend').detect_syntax(Text=text, LanguageCode='en')
+    df = pd.DataFrame(response['SyntaxTokens'])
     df['Tag'] = df['PartOfSpeech'].apply(lambda x: x['Tag'])
     df['Score'] = df['PartOfSpeech'].apply(lambda x: x['Score'])
     df = df.drop(columns=['PartOfSpeech'])
     return df
 
 def comprehend_entities(text):
-    response = comprehend.detect_entities(Text=text, LanguageCode='en')
-    df = pd.read_json(io.StringIO(json.dumps(response['Entities'])))
+    response = aws_client('comprehend').detect_entities(Text=text, LanguageCode='en')
+    df = pd.DataFrame(response['Entities'])
     return df
 
 def comprehend_phrases(text):
-    response = comprehend.detect_key_phrases(Text=text, LanguageCode='en')
-    df = pd.read_json(io.StringIO(json.dumps(response['KeyPhrases'])))
+    response = aws_client('comprehend').detect_key_phrases(Text=text, LanguageCode='en')
+    df = pd.DataFrame(response['KeyPhrases'])
     return df
 
 def comprehend_sentiment(text):
-    response = comprehend.detect_sentiment(Text=text, LanguageCode='en')
+    response = aws_client('comprehend').detect_sentiment(Text=text, LanguageCode='en')
     return response['SentimentScore']
+
+# Corpus level variants of the comprehend functions. Documents are split into pieces within
+# the service size limit, sent 25 at a time to the batch_detect_* APIs on a thread pool, and
+# every result row keeps the index of its document in the corpus.
+
+COMPREHEND_BATCH_SIZE = 25
+COMPREHEND_MAX_BYTES = 5000
+
+def split_text(text, max_bytes=COMPREHEND_MAX_BYTES):
+    # Pieces of at most max_bytes UTF-8 bytes, cut after whitespace where possible,
+    # with the character offset of each piece in the text
+    data = text.encode('utf-8')
+    chunks = []
+    start = 0
+    offset = 0
+    while start < len(data):
+        end = min(start + max_bytes, len(data))
+        if end < len(data):
+            cut = max(data.rfind(b' ', start, end), data.rfind(b'\n', start, end)) + 1
+            if cut > start:
+                end = cut
+            else:
+                # No whitespace, cut on a character boundary
+                while (data[end] & 0xC0) == 0x80:
+                    end -= 1
+        chunk = data[start:end].decode('utf-8')
+        if chunk.strip():
+            chunks.append((offset, chunk))
+        offset += len(chunk)
+        start = end
+    return chunks
+
+def _comprehend_batch(texts, method, language='en', workers=4, max_bytes=COMPREHEND_MAX_BYTES):
+    pieces = [(document, offset, chunk) for document, text in enumerate(texts)
+              for offset, chunk in split_text(text, max_bytes)]
+    batches = [pieces[i:i + COMPREHEND_BATCH_SIZE] for i in range(0, len(pieces), COMPREHEND_BATCH_SIZE)]
+    fn = getattr(aws_client('comprehend'), method)
+
+    def detect(batch):
+        response = call_with_retry(fn, TextList=[chunk for _, _, chunk in batch], LanguageCode=language)
+        return ([(batch[r['Index']], r) for r in response['ResultList']],
+                [(batch[e['Index']], e) for e in response['ErrorList']])
+
+    results = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_results, batch_errors in executor.map(detect, batches):
+            results.extend(batch_results)
+            errors.extend(batch_errors)
+    if errors:
+        (document, offset, _), error = errors[0]
+        print(f'{len(errors)} of {len(pieces)} pieces failed, first: document {document} '
+              f'at {offset} ({error["ErrorCode"]}: {error["ErrorMessage"]})')
+    return results
+
+def comprehend_syntax_batch(texts, language='en', workers=4):
+    columns = {'Document': [], 'TokenId': [], 'Text': [], 'BeginOffset': [], 'EndOffset': [], 'Tag': [], 'Score': []}
+    for (document, offset, _), result in _comprehend_batch(texts, 'batch_detect_syntax', language, workers):
+        for token in result['SyntaxTokens']:
+            columns['Document'].append(document)
+            columns['TokenId'].append(token['TokenId'])
+            columns['Text'].append(token['Text'])
+            columns['BeginOffset'].append(token['BeginOffset'] + offset)
+            columns['EndOffset'].append(token['EndOffset'] + offset)
+            columns['Tag'].append(token['PartOfSpeech']['Tag'])
+            columns['Score'].append(token['PartOfSpeech']['Score'])
+    return pd.DataFrame(columns)
+
+def _comprehend_spans(texts, method, result_key, language, workers):
+    columns = {'Document': [], 'Text': [], 'Score': [], 'BeginOffset': [], 'EndOffset': []}
+    if result_key == 'Entities':
+        columns['Type'] = []
+    for (document, offset, _), result in _comprehend_batch(texts, method, language, workers):
+        for span in result[result_key]:
+            columns['Document'].append(document)
+            columns['Text'].append(span['Text'])
+            columns['Score'].append(span['Score'])
+            columns['BeginOffset'].append(span['BeginOffset'] + offset)
+            columns['EndOffset'].append(span['EndOffset'] + offset)
+            if 'Type' in columns:
+                columns['Type'].append(span['Type'])
+    return pd.DataFrame(columns)
+
+def comprehend_entities_batch(texts, language='en', workers=4):
+    return _comprehend_spans(texts, 'batch_detect_entities', 'Entities', language, workers)
+
+def comprehend_phrases_batch(texts, language='en', workers=4):
+    return _comprehend_spans(texts, 'batch_detect_key_phrases', 'KeyPhrases', language, workers)
+
+def comprehend_sentiment_batch(texts, language='en', workers=4):
+    # One row per document piece, Offset is the character offset of the piece
+    columns = {'Document': [], 'Offset': [], 'Sentiment': [], 'Positive': [], 'Negative': [], 'Neutral': [], 'Mixed': []}
+    for (document, offset, _), result in _comprehend_batch(texts, 'batch_detect_sentiment', language, workers):
+        columns['Document'].append(document)
+        columns['Offset'].append(offset)
+        columns['Sentiment'].append(result['Sentiment'])
+        for score in ['Positive', 'Negative', 'Neutral', 'Mixed']:
+            columns[score].append(result['SentimentScore'][score])
+    return pd.DataFrame(columns)
     
 def show_video(bucket, key, size=100, autoplay=False, controls=True):
+    from IPython.display import HTML
+
     source = f'https://s3.amazonaws.com/{bucket}/{key}'
     html = '''
     <div align="middle">
@@ -276,16 +1689,17 @@ def show_video(bucket, key, size=100, autoplay=False, controls=True):
 
 def video_labels_job(bucket, key):
     video = {'S3Object': {'Bucket': bucket, 'Name': key}}
-    response_detect = rekognition.start_label_detection(Video = video)
+    response_detect = aws_client('rekognition').start_label_detection(Video = video)
     return response_detect['JobId']
 
 
 def video_labels_result(jobId):
+    from IPython.display import display
     display('In Progress...')
-    response_label = rekognition.get_label_detection(JobId=jobId)
+    response_label = aws_client('rekognition').get_label_detection(JobId=jobId)
     while response_label['JobStatus'] == 'IN_PROGRESS':
         time.sleep(5)
-        response_label = rekognition.get_label_detection(JobId=jobId)
+        response_label = aws_client('rekognition').get_label_detection(JobId=jobId)
 
     display('Getting Labels...')
     display(f"Video Duration (ms): {response_label['VideoMetadata']['DurationMillis']}")
@@ -295,29 +1709,49 @@ def video_labels_result(jobId):
     while response_label:
         labels.extend(response_label['Labels'])
         if 'NextToken' in response_label:
-            response_label = rekognition.get_label_detection(JobId=jobId, NextToken=response_label['NextToken']) 
+            response_label = aws_client('rekognition').get_label_detection(JobId=jobId, NextToken=response_label['NextToken']) 
         else:
             response_label = None
     
     display(f'Succeeded in detecting {len(labels)} labels.')
-    
-    df = pd.DataFrame(labels)
-    df['LabelName'] = df['Label'].apply(lambda x: x['Name'])
-    df['Score'] = df['Label'].apply(lambda x: round(float(x['Confidence']), 2))
-    df['Instances'] = df['Label'].apply(lambda x: len(x['Instances']) if x['Instances'] else 0)
-    df['ParentsCount'] = df['Label'].apply(lambda x: len(x['Parents']))
-    df['Parents'] = df['Label'].apply(lambda x: ', '.join(map(lambda x : x['Name'], x['Parents'])))
-    df = df.drop(columns=['Label'])
-    return df    
+    return video_labels_frame(labels)
+
+def video_labels_frame(labels):
+    # Flatten the detections into column arrays in a single pass. The frame is indexed
+    # by the sorted Timestamp (ms) and LabelName is categorical.
+    count = len(labels)
+    timestamps = np.empty(count, dtype='int64')
+    scores = np.empty(count)
+    instances = np.empty(count, dtype='int64')
+    parents_count = np.empty(count, dtype='int64')
+    names = [None] * count
+    parents = [None] * count
+    for i, detection in enumerate(labels):
+        label = detection['Label']
+        label_parents = label.get('Parents') or ()
+        timestamps[i] = detection['Timestamp']
+        names[i] = label['Name']
+        scores[i] = label['Confidence']
+        instances[i] = len(label.get('Instances') or ())
+        parents_count[i] = len(label_parents)
+        parents[i] = ', '.join([parent['Name'] for parent in label_parents])
+
+    df = pd.DataFrame({
+        'LabelName': pd.Categorical(names),
+        'Score': scores.round(2),
+        'Instances': instances,
+        'ParentsCount': parents_count,
+        'Parents': parents,
+    }, index=pd.Index(timestamps, name='Timestamp'))
+    return df.sort_index(kind='stable')
 
 def video_labels_text(df):
-    si = io.StringIO()
-    df['LabelName'].apply(lambda x: si.write(str(x + ' ')))
-    s = si.getvalue()
-    si.close()
-    return s
+    return ''.join(name + ' ' for name in df['LabelName'].astype(str))
 
 def video_labels_wordcloud(text):
+    import matplotlib.pyplot as plt
+    from wordcloud import WordCloud
+
     # take relative word frequencies into account, lower max_font_size
     wordcloud = WordCloud(width = 600, height = 300, background_color = 'black', max_words = len(text),
                         max_font_size = 30, relative_scaling = .5, colormap = 'Spectral').generate(text)
@@ -328,6 +1762,11 @@ def video_labels_wordcloud(text):
     plt.show()
 
 def video_labels_search(df, column, match):
+    if isinstance(df[column].dtype, pd.CategoricalDtype):
+        # Match the distinct labels once instead of every row
+        categories = df[column].cat.categories
+        codes = np.flatnonzero(categories.str.contains(match))
+        return df[np.isin(df[column].cat.codes.to_numpy(), codes)]
     df_result = df[df[column].str.contains(match)]
     return df_result
 
@@ -338,15 +1777,16 @@ def video_label_stats(df, label):
 
 def video_persons_job(bucket, key):
     video = {'S3Object': {'Bucket': bucket, 'Name': key}}
-    response_detect = rekognition.start_person_tracking(Video = video)
+    response_detect = aws_client('rekognition').start_person_tracking(Video = video)
     return response_detect['JobId']    
 
 def video_persons_result(jobId):
+    from IPython.display import display
     display('In Progress...')
-    response_person = rekognition.get_person_tracking(JobId=jobId)
+    response_person = aws_client('rekognition').get_person_tracking(JobId=jobId)
     while response_person['JobStatus'] == 'IN_PROGRESS':
         time.sleep(5)
-        response_label = rekognition.get_person_tracking(JobId=jobId)
+        response_person = aws_client('rekognition').get_person_tracking(JobId=jobId)
 
     display('Getting Person Paths...')
     display(f"Video Codec: {response_person['VideoMetadata']['Codec']}")
@@ -358,29 +1798,169 @@ def video_persons_result(jobId):
     while response_person:
         persons.extend(response_person['Persons'])
         if 'NextToken' in response_person:
-            response_person = rekognition.get_person_tracking(JobId=jobId, NextToken=response_person['NextToken']) 
+            response_person = aws_client('rekognition').get_person_tracking(JobId=jobId, NextToken=response_person['NextToken']) 
         else:
             response_person = None
     
     display(f'Succeeded in detecting {len(persons)} person paths.')
-    
-    df = pd.DataFrame(persons)
-    df['Left'] = df['Person'].apply(lambda x: round(x['BoundingBox']['Left'], 2) if 'BoundingBox' in x else '')
-    df['Top'] = df['Person'].apply(lambda x: round(x['BoundingBox']['Top'], 2) if 'BoundingBox' in x else '')
-    df['Height'] = df['Person'].apply(lambda x: round(x['BoundingBox']['Height'], 2) if 'BoundingBox' in x else '')
-    df['Width'] = df['Person'].apply(lambda x: round(x['BoundingBox']['Width'], 2) if 'BoundingBox' in x else '')
-    df['Index'] = df['Person'].apply(lambda x: x['Index'])
-    df = df.drop(columns=['Person'])
+    return video_persons_frame(persons)
 
-    return df
+def video_persons_frame(persons):
+    # Same layout as video_labels_frame, bounding box values are NaN when Rekognition omits them
+    count = len(persons)
+    timestamps = np.empty(count, dtype='int64')
+    index = np.empty(count, dtype='int64')
+    boxes = np.full((count, 4), np.nan)
+    for i, detection in enumerate(persons):
+        person = detection['Person']
+        timestamps[i] = detection['Timestamp']
+        index[i] = person['Index']
+        box = person.get('BoundingBox')
+        if box:
+            boxes[i] = (box['Left'], box['Top'], box['Height'], box['Width'])
+
+    boxes = boxes.round(2)
+    df = pd.DataFrame({
+        'Left': boxes[:, 0],
+        'Top': boxes[:, 1],
+        'Height': boxes[:, 2],
+        'Width': boxes[:, 3],
+        'Index': index,
+    }, index=pd.Index(timestamps, name='Timestamp'))
+    return df.sort_index(kind='stable')
 
 def video_person_path(df, person):
     df_result = df[df['Index'] == person]
     return df_result
 
 def video_person_timeframe(df, start, end):
-    df_result = df[(df['Timestamp'] >= start) & (df['Timestamp'] <= end)]
+    # Binary search on the sorted Timestamp index
+    df_result = df.loc[start:end]
     return df_result
 
 def video_persons_frequency(df):
-    return df.groupby('Index')['Timestamp'].nunique()
\ No newline at end of file
+    return df.reset_index().groupby('Index')['Timestamp'].nunique()
+
+# Indexed store over a labels or persons frame for repeated interactive queries. Row positions
+# are grouped per label name and per person index, and timestamps are searched with bisection.
+
+def _positions_by(values):
+    # {value: sorted row positions} from one stable argsort
+    order = np.argsort(values, kind='stable')
+    distinct, starts = np.unique(values[order], return_index=True)
+    return dict(zip(distinct.tolist(), np.split(order, starts[1:])))
+
+def video_index(df):
+    index = {'frame': df, 'timestamps': df.index.to_numpy()}
+    if 'LabelName' in df:
+        labels = df['LabelName'].astype('category')
+        codes = _positions_by(labels.cat.codes.to_numpy())
+        index['labels'] = {labels.cat.categories[code]: positions for code, positions in codes.items()}
+        index['label_stats'] = df.reset_index().groupby('LabelName', observed=True).agg(
+            Detections=('Timestamp', 'size'), First=('Timestamp', 'min'), Last=('Timestamp', 'max'),
+            MeanScore=('Score', 'mean'), Instances=('Instances', 'sum'))
+    if 'Index' in df:
+        index['persons'] = _positions_by(df['Index'].to_numpy())
+        index['person_stats'] = df.reset_index().groupby('Index').agg(
+            Detections=('Timestamp', 'size'), First=('Timestamp', 'min'), Last=('Timestamp', 'max'),
+            Frames=('Timestamp', 'nunique'))
+    return index
+
+def _index_rows(index, positions, start, end):
+    if start is not None or end is not None:
+        timestamps = index['timestamps'][positions]
+        lo = 0 if start is None else np.searchsorted(timestamps, start, 'left')
+        hi = len(positions) if end is None else np.searchsorted(timestamps, end, 'right')
+        positions = positions[lo:hi]
+    return index['frame'].iloc[positions]
+
+def video_index_timeframe(index, start, end):
+    timestamps = index['timestamps']
+    return index['frame'].iloc[np.searchsorted(timestamps, start, 'left'):np.searchsorted(timestamps, end, 'right')]
+
+def video_index_label(index, label, start=None, end=None):
+    positions = index['labels'].get(label, np.empty(0, dtype='int64'))
+    return _index_rows(index, positions, start, end)
+
+def video_index_person(index, person, start=None, end=None):
+    positions = index['persons'].get(person, np.empty(0, dtype='int64'))
+    return _index_rows(index, positions, start, end)
+
+def video_index_search(index, match, start=None, end=None):
+    # Rows of every label whose name contains match
+    groups = [positions for label, positions in index['labels'].items() if re.search(match, label)]
+    positions = np.sort(np.concatenate(groups)) if groups else np.empty(0, dtype='int64')
+    return _index_rows(index, positions, start, end)
+
+# Concurrent video jobs. Jobs are started and polled from the event loop with backoff,
+# so a notebook can await a whole video library while other cells keep running.
+
+VIDEO_JOBS = {
+    'labels': ('start_label_detection', 'get_label_detection', 'Labels', video_labels_frame),
+    'persons': ('start_person_tracking', 'get_person_tracking', 'Persons', video_persons_frame),
+}
+
+async def _rekognition_call(method, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(call_with_retry, getattr(aws_client('rekognition'), method), **kwargs))
+
+async def video_job_start(bucket, key, kind='labels'):
+    response = await _rekognition_call(VIDEO_JOBS[kind][0], Video={'S3Object': {'Bucket': bucket, 'Name': key}})
+    return response['JobId']
+
+async def video_job_wait(jobId, kind='labels', delay=2, max_delay=30):
+    while True:
+        response = await _rekognition_call(VIDEO_JOBS[kind][1], JobId=jobId, MaxResults=1)
+        if response['JobStatus'] != 'IN_PROGRESS':
+            break
+        await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+        delay = min(delay*2, max_delay)
+    if response['JobStatus'] != 'SUCCEEDED':
+        raise RuntimeError(f"Video job {jobId} {response['JobStatus']}: {response.get('StatusMessage', '')}")
+    return response['VideoMetadata']
+
+async def video_job_pages(jobId, kind='labels'):
+    # Async generator of the detections of a finished job, one result page at a time
+    params = {'JobId': jobId}
+    while True:
+        response = await _rekognition_call(VIDEO_JOBS[kind][1], **params)
+        yield response[VIDEO_JOBS[kind][2]]
+        if 'NextToken' not in response:
+            break
+        params['NextToken'] = response['NextToken']
+
+async def video_job_result(jobId, kind='labels'):
+    await video_job_wait(jobId, kind)
+    items = []
+    async for page in video_job_pages(jobId, kind):
+        items.extend(page)
+    return VIDEO_JOBS[kind][3](items)
+
+async def video_jobs(bucket, keys, kind='labels', concurrency=20, progress=None):
+    # Analyse many videos at once, at most concurrency jobs in flight (the default
+    # Rekognition limit of concurrent stored video jobs). Returns {key: DataFrame};
+    # pass a progress dict to follow the state of every video while the jobs run.
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = {} if progress is None else progress
+    progress.update({key: 'QUEUED' for key in keys})
+
+    async def run(key):
+        async with semaphore:
+            progress[key] = 'IN_PROGRESS'
+            try:
+                jobId = await video_job_start(bucket, key, kind)
+                df = await video_job_result(jobId, kind)
+            except Exception:
+                progress[key] = 'FAILED'
+                raise
+            progress[key] = 'SUCCEEDED'
+            done = sum(state in ('SUCCEEDED', 'FAILED') for state in progress.values())
+            print(f'{done} of {len(progress)} videos analysed', end='\r')
+            return key, df
+
+    results = await asyncio.gather(*(run(key) for key in keys), return_exceptions=True)
+    print()
+    failed = [(key, result) for key, result in zip(keys, results) if isinstance(result, Exception)]
+    if failed:
+        print(f'{len(failed)} of {len(keys)} videos failed, first: {failed[0][0]} ({failed[0][1]})')
+    return dict(result for result in results if not isinstance(result, Exception))